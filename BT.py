@@ -1,12 +1,77 @@
 import pandas as pd
 import numpy as np
 from strategy import myStrategy
+from sizing import weight_matrix
+from panel import Panel, PanelView
+import features
+import analytics
+import schedule
+import resultcache
+from profiling import Profiler, NullProfiler
 import matplotlib.pyplot as plt
 import math
 
+COST_FIELDS = ('close', 'valuevolume', 'rolling_std', 'pctChg')  # Price data handed to cost models
+
+
+# Batched cost models. Each takes `amount`, an array of traded values, and `data`, a mapping of the fields in COST_FIELDS
+# to arrays (or scalars) that broadcast against it, and returns an array with the cost of every trade.
+# They work the same on the trades of one date, a (dates x tickers) matrix for a whole backtest, or a single trade.
+
+# Market impact model from Multi-Period Trading via Convex Optimization: a * |x| + b * sigma / sqrt(V) * |x|^(3/2) + c * x, divided by the close price.
+# Trades with zero volume or missing data cost nothing.
+def market_impact_cost(amount, data, a=0.0005, b=1, c=0):
+    x = np.asarray(amount, dtype=float)
+    close = np.asarray(data['close'], dtype=float)
+    volume = np.asarray(data['valuevolume'], dtype=float) * close
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cost = (a * np.abs(x) + b * np.asarray(data['rolling_std'], dtype=float) / np.sqrt(volume) * np.abs(x)**(3/2) + c * x) / close
+    return np.where((volume == 0) | np.isnan(cost), 0, cost)
+
+
+# Fixed rate model: the cost is a fixed rate of the amount traded.
+def fixed_cost(amount, data, fee_rate=0):
+    return np.asarray(amount, dtype=float) * fee_rate
+
+
+# This function returns the batched cost function for a t_cost setting:
+# ['default'] is the market impact model, ['fixed', rate] the fixed rate model, and [func, *args] calls func(amount, data, *args),
+# where func follows the same batched signature as the built-in models. Any other setting costs nothing.
+def make_cost_model(t_cost, a=0.0005, b=1):
+    if t_cost[0] == 'default':
+        return lambda amount, data: market_impact_cost(amount, data, a=a, b=b)
+    if t_cost[0] == 'fixed':
+        return lambda amount, data: fixed_cost(amount, data, fee_rate=t_cost[1])
+    if callable(t_cost[0]):
+        return lambda amount, data: t_cost[0](amount, data, *t_cost[1:])
+    return lambda amount, data: np.zeros(np.shape(amount))
+
+
+# This function computes, for every date, the coefficients of the transaction cost as a function of cash: cost = A * cash + B * cash**1.5.
+# This is the closed form of market_impact_cost and fixed_cost over a whole backtest; it returns (None, None) for custom models,
+# which are evaluated date by date instead. Weights are (dates x tickers), or (strategies x dates x tickers) for (strategies x dates) coefficients.
+def cost_coefficients(t_cost, weights, prev_weights, close, valuevolume, rolling_std, a=0.0005, b=1):
+    traded = np.abs(weights - prev_weights)
+    touched = (weights != 0) | (prev_weights != 0)
+    if t_cost[0] == 'default':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            volume = valuevolume * close
+            A = a * traded / close
+            B = b * rolling_std / np.sqrt(volume) * traded**1.5 / close
+        invalid = ~touched | (volume == 0) | np.isnan(A) | np.isnan(B)
+        A = np.where(invalid, 0, A)
+        B = np.where(invalid, 0, B)
+    elif t_cost[0] == 'fixed':
+        A = np.where(touched, traded * t_cost[1], 0)
+        B = np.zeros_like(A)
+    else:
+        return None, None
+    return A.sum(axis=-1), B.sum(axis=-1)
+
+
 # Class: TransactionCost
-# This class calculates transaction costs based on different models.
-# Models supported: 'default', 'fixed', or custom callable models.
+# This class calculates the transaction cost of a single trade based on different models.
+# Models supported: 'default', 'fixed', or custom callable models; it evaluates the batched cost models above on one trade.
 class TransactionCost:
     def __init__(self, model=['default'], data=None, amount=0, **kwargs):
         self.data = data
@@ -18,7 +83,7 @@ class TransactionCost:
             self.value = self.model2(**kwargs)
         else:
             if callable(self.model[0]):
-                self.value = model(**kwargs)
+                self.value = float(np.sum(self.model[0](np.array([amount]), data, *self.model[1:])))
             else:
                 self.value = 0
     
@@ -26,42 +91,61 @@ class TransactionCost:
     def model1(self, a=0.0005, b=1, c=0, **kwargs):
         if self.data.empty:
             return 0
-        x = self.amount
-        volume = self.data['valuevolume'] * self.data['close']
-        if volume == 0:
-            return 0
-        sigma = self.data['rolling_std'] 
-        cost = a * abs(x) + b * sigma / np.sqrt(volume) * abs(x)**(3/2) + c * x
-        cost = cost / self.data['close']
-
-        if math.isnan(cost):
-            return 0
-        
-        return cost
+        return float(market_impact_cost(self.amount, self.data, a=a, b=b, c=c))
     
     # Model 2: Fixed transaction cost model, calculates the cost as a fixed rate of the amount traded.
     def model2(self, **kwargs):
-        fee_rate = self.model[1]
-        return self.amount * fee_rate
+        return float(fixed_cost(self.amount, self.data, fee_rate=self.model[1]))
+
 
 
+# This function pivots the per-ticker frames into dense (dates x tickers) arrays, one per field. Missing dates or columns become NaN.
+def price_matrices(dict_ticker, dates, tickers, fields):
+    if isinstance(dict_ticker, PanelView):
+        return {field: dict_ticker.panel.matrix(field, dates, tickers) for field in fields}
+    matrices = {}
+    for field in fields:
+        columns = {ticker: dict_ticker[ticker][field] for ticker in tickers if field in dict_ticker[ticker].columns}
+        frame = pd.DataFrame(columns).reindex(index=dates, columns=tickers)
+        matrices[field] = frame.to_numpy(dtype=float)
+    return matrices
 
 # This class simulates a backtest using a given strategy, tracking portfolio value over time and incorporating transaction costs and holding fees. It can generate backtest statistics and visualizations.
+# If the strategy has a rebalance schedule, trades happen only on its rebalance dates (and the first date of the backtest), and are
+# measured from the holdings marked to the day's returns; on other dates the drifted positions are held at no cost.
 class BacktestModule:
-    def __init__(self, strategy_instance, t_cost=['default'], start=None, end=None, holding_feerate=0.03, initial_cash=100_0000):
+    # Set engine='vectorized' to run the backtest on dense (dates x tickers) arrays instead of the per-ticker loop in `rebalance`.
+    # Set profile=True to time each phase of the run (see profiling.py and profile_report), and profile_dump to a file path to also write cProfile stats there.
+    # cache=True (or a directory or resultcache.ResultCache) makes run_backtest load the stored result when the strategy and parameters are unchanged.
+    def __init__(self, strategy_instance, t_cost=['default'], start=None, end=None, holding_feerate=0.03, initial_cash=100_0000, engine='loop', profile=False, profile_dump=None, cache=None):
+        if engine not in ('loop', 'vectorized'):
+            raise ValueError("Invalid engine. Must be 'loop' or 'vectorized'.")
         self.strategy = strategy_instance
         self.price_data = self.strategy.UNI.dict_ticker
 
+        # The 'default' cost model needs each stock's rolling_std. If the universe has no such column, the 180-day rolling std of close
+        # is added to a shallow copy of the panel, so the universe itself is left untouched.
+        panel = getattr(self.strategy.UNI, 'panel', None)
+        if t_cost[0] == 'default' and panel is not None and 'rolling_std' not in panel.fields:
+            rolling_std = panel.fields['rolling_std_180'] if 'rolling_std_180' in panel.fields else features.compute(panel, 'rolling_std_180')
+            self.price_data = Panel(panel.dates, panel.tickers, dict(panel.fields, rolling_std=rolling_std), panel.present).by_ticker
+
         # Filter dates based on the specified start and end dates
         self.dates = [date for date in self.strategy.dates if date >= start and date <= end]
         self.cash = initial_cash
+        self.initial_cash = initial_cash
         self.portfolio_value = {start: initial_cash}
         self.holdings = {}
 
         self.tcost_model = t_cost  # Transaction cost model
+        self.cost_model = make_cost_model(t_cost)  # Batched cost function for the model
         self.holding_feerate = holding_feerate  # Holding fee rate (annual)
         self.start = start
         self.end = end
+        self.engine = engine
+        self.trade_dates = None  # Dates with trades under the strategy's rebalance schedule, set by run_backtest; None means every date
+        self.cache = resultcache.make_cache(cache)  # Result cache used by run_backtest, or None
+        self.profiler = Profiler(dump=profile_dump) if profile or profile_dump is not None else NullProfiler()
 
 
     # This method rebalances the portfolio on the given date, adjusting holdings and applying transaction costs and holding fees.
@@ -70,31 +154,44 @@ class BacktestModule:
             self.portfolio_value[current_date] = 0
             return
 
+        profiler = self.profiler
         # Get new positions from the strategy for the current date
-        new_positions = self.strategy.position_dict.get(current_date, {})
-        tickers_to_change = set(self.holdings.keys()) | set(new_positions.keys())
+        with profiler.phase('positions'):
+            new_positions = self.strategy.position_dict.get(current_date, {})
+            tickers_to_change = set(self.holdings.keys()) | set(new_positions.keys())
         
         returns = 0
         transaction_cost = 0
-        holding_cost = self.holding_fee()
-
-        for ticker in tickers_to_change:
-            temp = self.price_data[ticker].loc[current_date]
-            position_change = abs(self.holdings.get(ticker, 0) - new_positions.get(ticker, 0)) 
-            amount = abs(position_change) * self.cash
-            
-            # Calculate transaction cost
-            transaction_cost += TransactionCost(model=self.tcost_model, a=0.0005, b=1, data=temp, amount=amount).value
-
-            # Calculate returns
-            if self.holdings.get(ticker, 0) != 0:
-                returns += (temp['pctChg'] * self.holdings[ticker] * self.cash)
-
-            # Update holdings
-            if new_positions.get(ticker, 0) == 0:
-                del self.holdings[ticker]
-            else:
-                self.holdings[ticker] = new_positions[ticker]
+        trading = self.trade_dates is None or current_date in self.trade_dates
+        with profiler.phase('holding_fee'):
+            holding_cost = self.holding_fee()
+
+        tickers = list(tickers_to_change)
+        with profiler.phase('price_lookup'):
+            rows = [self.price_data[ticker].loc[current_date] for ticker in tickers]
+
+        # Calculate transaction costs of all of the day's trades in one batched call
+        if tickers and trading:
+            with profiler.phase('transaction_cost'):
+                before = self.holdings
+                if self.trade_dates is not None:
+                    held = schedule.mark_day(np.array([self.holdings.get(ticker, 0) for ticker in tickers]), np.array([row['pctChg'] for row in rows], dtype=float))
+                    before = dict(zip(tickers, held))
+                amounts = np.array([abs(before.get(ticker, 0) - new_positions.get(ticker, 0)) * self.cash for ticker in tickers])
+                data = {field: np.array([row[field] for row in rows], dtype=float) for field in COST_FIELDS if field in rows[0].index}
+                transaction_cost = float(np.sum(self.cost_model(amounts, data)))
+
+        with profiler.phase('bookkeeping'):
+            for ticker, temp in zip(tickers, rows):
+                # Calculate returns
+                if self.holdings.get(ticker, 0) != 0:
+                    returns += (temp['pctChg'] * self.holdings[ticker] * self.cash)
+
+                # Update holdings
+                if new_positions.get(ticker, 0) == 0:
+                    del self.holdings[ticker]
+                else:
+                    self.holdings[ticker] = new_positions[ticker]
         
         # Update cash after returns, transaction costs, and holding fees
         self.cash += returns - transaction_cost - holding_cost
@@ -113,31 +210,108 @@ class BacktestModule:
 
     # This method runs the backtest by rebalancing the portfolio on each date in the specified date range.
     def run_backtest(self):
-        for date in self.dates:
-            self.rebalance(date)
+        if self.cache is not None:
+            key = resultcache.backtest_key(self)
+            if self.cache.restore(key, self):
+                return
+        if self.strategy.rebalance_dates is not None:
+            self.trade_dates = set(self.strategy.rebalance_dates) | set(self.dates[:1])
+        with self.profiler.run():
+            if self.engine == 'vectorized':
+                self.run_vectorized()
+            else:
+                for date in self.dates:
+                    with self.profiler.day():
+                        self.rebalance(date)
+        if self.cache is not None:
+            self.cache.store(key, self, resultcache.BACKTEST_RESULTS)
+        return
+
+    # This method computes, for every date, the coefficients of the transaction cost as a function of cash (see cost_coefficients).
+    def cost_coefficients(self, weights, prev_weights, close, valuevolume, rolling_std, a=0.0005, b=1):
+        return cost_coefficients(self.tcost_model, weights, prev_weights, close, valuevolume, rolling_std, a=a, b=b)
+
+    # This method runs the backtest as whole-array operations and gives the same portfolio_value as the loop in `rebalance`.
+    # Returns, transaction costs and holding fees are computed for all dates at once; only the scalar cash recursion is sequential.
+    def run_vectorized(self):
+        if len(self.dates) == 0:
+            return
+        profiler = self.profiler
+        with profiler.phase('positions'):
+            tickers = sorted({ticker for date in self.dates for ticker in self.strategy.position_dict.get(date, {})})
+            weights = weight_matrix(self.strategy.position_dict, self.dates, tickers)
+            prev_weights = np.vstack([np.zeros((1, len(tickers))), weights[:-1]])
+        with profiler.phase('price_lookup'):
+            fields = price_matrices(self.price_data, self.dates, tickers, COST_FIELDS)
+
+        # Returns are earned on the previous day's holdings; NaN prices propagate just like in the loop.
+        with profiler.phase('returns'):
+            returns = np.where(prev_weights != 0, prev_weights * fields['pctChg'], 0).sum(axis=1)
+        with profiler.phase('holding_fee'):
+            short_exposure = np.where(prev_weights < 0, -prev_weights, 0).sum(axis=1)
+            holding = short_exposure * ((1 + self.holding_feerate)**(1/252) - 1)
+        with profiler.phase('transaction_cost'):
+            before = prev_weights
+            if self.trade_dates is not None:
+                # Trades start from the holdings marked to the day's returns; dates without trades keep the drifted positions
+                trade_days = np.array([date in self.trade_dates for date in self.dates])
+                before = np.where(trade_days[:, None], schedule.mark_day(prev_weights, fields['pctChg']), weights)
+            A, B = self.cost_coefficients(weights, before, fields['close'], fields['valuevolume'], fields['rolling_std'])
+            traded = np.abs(weights - before)
+            touched = (traded != 0) if self.trade_dates is not None else (weights != 0) | (prev_weights != 0)
+
+        cash = self.cash
+        last = -1
+        for i, date in enumerate(self.dates):
+            if math.isnan(cash) or cash == 0:
+                self.portfolio_value[date] = 0
+                continue
+            if A is not None:
+                transaction_cost = A[i] * cash + B[i] * cash**1.5
+            else:
+                with profiler.phase('transaction_cost'):
+                    trades = touched[i]
+                    transaction_cost = float(np.sum(self.cost_model(traded[i, trades] * cash, {field: fields[field][i, trades] for field in COST_FIELDS})))
+            cash += cash * (returns[i] - holding[i]) - transaction_cost
+            cash = max(cash, 0)
+            self.portfolio_value[date] = cash
+            last = i
+        self.cash = cash
+        self.holdings = {} if last < 0 else {ticker: w for ticker, w in zip(tickers, weights[last]) if w != 0}
         return
 
+    # This method calculates key statistics from the backtest and returns them as a dictionary (see analytics.summary for the list).
+    def summary(self, benchmark=None):
+        stats = analytics.summary(pd.Series(self.portfolio_value), benchmark=benchmark, weights=self.weight_history())
+        return {name: float(value) for name, value in stats.iloc[0].items()}
+
+    # This method returns the (dates x tickers) weights held on each date of portfolio_value, with tickers in sorted order.
+    def weight_history(self):
+        dates = list(self.portfolio_value.keys())
+        tickers = sorted({ticker for date in dates for ticker in self.strategy.position_dict.get(date, {})})
+        return weight_matrix(self.strategy.position_dict, dates, tickers)
+
+    # This method returns the full analytics of the backtest (see analytics.analyze): the summary plus drawdown, drawdown duration,
+    # rolling volatility, Sharpe and Sortino over `window` days, turnover and exposure, and alpha/beta when a benchmark value series is given.
+    def analyze(self, benchmark=None, window=63):
+        return analytics.analyze(pd.Series(self.portfolio_value), benchmark=benchmark, weights=self.weight_history(), window=window)
+
     # This method calculates and prints key statistics from the backtest.
     def statistics(self):
         values = list(self.portfolio_value.values())
-        daily_returns = np.diff(values) / values[:-1]
-        mean_return = np.mean(daily_returns)
-        std_return = np.std(daily_returns)
-        risk_free_rate = (1.02)**(1/252) - 1
-        total_return = values[-1] / values[0]
-        years = len(values) / 252
-        cagr = (1 + total_return)**(1 / years) - 1
-        sharpe = (mean_return - risk_free_rate) / std_return * np.sqrt(252)
-        hwm = [max(values[0:i+1]) for i in range(len(values))]
-        dd = [1 - values[i] / hwm[i] for i in range(len(values))]
-        
-        print('Sharpe ratio: ' + str(sharpe) + '\n')
-        print('Average drawdown: ' + str(np.mean(dd)) + '\n')
-        print('Max drawdown: ' + str(max(dd)) + '\n')
-        print('CAGR: ' + str(cagr) + '\n')
+        stats = self.summary()
+        print('Sharpe ratio: ' + str(stats['sharpe']) + '\n')
+        print('Average drawdown: ' + str(stats['average_drawdown']) + '\n')
+        print('Max drawdown: ' + str(stats['max_drawdown']) + '\n')
+        print('CAGR: ' + str(stats['cagr']) + '\n')
         return values
 
 
+    # This method returns the profiling report of the last run (see profiling.Profiler.report), or None if the backtest was created without profile=True.
+    def profile_report(self):
+        return self.profiler.report()
+
+
     # This method plots the portfolio value over time.
     def plot(self, ax=None, label=None):
         if ax is None:
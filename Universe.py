@@ -1,82 +1,275 @@
-import cvxportfolio as cvx
+import logging
+import numpy as np
 import pandas as pd
 from pathlib import Path
 from tempfile import TemporaryDirectory
 import sl
+from panel import Panel
+import features
+from datasource import YahooSource, CachedSource, fetch_many
+
+
+# Derived rolling columns that `Universe.update` recomputes on the tail of each ticker's history.
+# Each entry is name -> (number of earlier rows the calculation needs, function of one ticker's frame).
+DERIVED_COLUMNS = {
+    'pctChg': (1, lambda df: df['close'].pct_change()),
+    'rolling_std': (179, lambda df: df['close'].rolling(window=180).std()),
+    'sharpe_ratio': (179, lambda df: df['return'].rolling(window=180).mean() / df['return'].rolling(window=180).std().replace(0, np.nan)),
+}
 
 
 # This class represents a collection of stocks and handles data preparation for backtesting.
-# Here all data is put into hash table form, which greatly speeds up the backtest and strategy calculationl.
+# Here all data is kept in a columnar panel with dictionary-style views by date and by ticker, which greatly speeds up the backtest and strategy calculationl.
 class Universe:
     def __init__(self, symbol_list, start='2018-01-03', end='2024-07-30') -> None:
         self.symbol_list = symbol_list  # List of stock tickers
-        self.dataframe = pd.DataFrame()  # Main dataframe to hold stock data
+        self._dataframe = pd.DataFrame()  # Main dataframe to hold stock data
         self.start = start  # Start date for the stock data
         self.end = end  # End date for the stock data
-        self.dict_date = {}  # Dictionary to store stock data organized by date
-        self.dict_ticker = {}  # Dictionary to store stock data organized by ticker
+        self.panel = Panel()  # Columnar (date x ticker) store behind dict_date and dict_ticker
+        self.failed_symbols = {}  # Symbols that could not be fetched by prepare(), with the error
+        self.features = {}  # Features attached to the panel by feature(), with their parameters
+
+    # Stock data organized by date, e.g. dict_date['2019-01-03'] is a DataFrame indexed by Ticker.
+    @property
+    def dict_date(self):
+        return self.panel.by_date
+
+    # Stock data organized by ticker, e.g. dict_ticker['PTT.BK'] is a DataFrame indexed by Date.
+    @property
+    def dict_ticker(self):
+        return self.panel.by_ticker
+
+    # Main dataframe (indexed by Date and Ticker). A universe opened from disk rebuilds it from the panel on first access.
+    @property
+    def dataframe(self):
+        if self._dataframe is None:
+            self._dataframe = self.panel.to_frame()
+        return self._dataframe
+
+    @dataframe.setter
+    def dataframe(self, value):
+        self._dataframe = value
+
+    # Universes pickled before the panel store kept dict_date and dict_ticker as dictionaries of DataFrames.
+    # Loading one of them rebuilds the panel from its dataframe, so old pickles keep working.
+    def __setstate__(self, state):
+        state = dict(state)
+        state.pop('dict_date', None)
+        if 'dataframe' in state:
+            state['_dataframe'] = state.pop('dataframe')
+        legacy_dict_ticker = state.pop('dict_ticker', None)
+        self.__dict__.update(state)
+        self.__dict__.setdefault('failed_symbols', {})
+        self.__dict__.setdefault('features', {})
+        if 'panel' in state:
+            return
+        if not self.dataframe.empty:
+            self.panel = Panel.from_frame(self.dataframe)
+        elif legacy_dict_ticker:
+            self.panel = Panel.from_frame(pd.concat([df.rename_axis('Date').reset_index() for df in legacy_dict_ticker.values()], ignore_index=True))
+        else:
+            self.panel = Panel()
+
+    # This method returns the metadata stored with the universe data by save and to_parquet.
+    def metadata(self):
+        return {'symbol_list': list(self.symbol_list),
+                'symbol_list_qualified': list(getattr(self, 'symbol_list_qualified', self.panel.tickers)),
+                'start': self.start,
+                'end': self.end,
+                'features': self.features}
+
+    # This method writes the universe to a directory of per-field binary arrays plus a small meta.json, which `Universe.open` memory-maps.
+    # The panel is what gets saved, so call coordinate() first if columns were added to the dataframe.
+    def save(self, path):
+        self.panel.save(path, meta=self.metadata())
+        return
+
+    # This method writes the universe data, every panel field including attached features, to a Parquet dataset (see sl.save_parquet),
+    # partitioned by year by default. The panel is written one block of dates at a time, so the long dataframe is never built in full.
+    def to_parquet(self, path, partition='year', block=250):
+        panel = self.panel
+        blocks = (Panel(panel.dates[i:i + block], panel.tickers, {name: array[i:i + block] for name, array in panel.fields.items()}, panel.present[i:i + block]).to_frame()
+                  for i in range(0, len(panel.dates), block))
+        sl.save_parquet(blocks, path, partition=partition, metadata=self.metadata())
+        return
+
+    # This method loads a universe from a Parquet dataset written by to_parquet, or from cleaned data written by load_data.load_all.
+    # Only the given tickers, dates (inclusive) and columns are read; 'Date' and 'Ticker' are always read.
+    @classmethod
+    def from_parquet(cls, path, tickers=None, start=None, end=None, columns=None):
+        if columns is not None:
+            columns = ['Date', 'Ticker'] + [column for column in columns if column not in ('Date', 'Ticker')]
+        df = sl.read_parquet(path, columns=columns, tickers=tickers, start=start, end=end)
+        if pd.api.types.is_datetime64_any_dtype(df['Date']):
+            df['Date'] = df['Date'].dt.strftime('%Y-%m-%d')
+        meta = sl.parquet_metadata(path)
+        panel = Panel.from_frame(df)
+        universe = cls(meta.get('symbol_list', list(panel.tickers)), start=start or meta.get('start', panel.dates[0] if panel.dates else None), end=end or meta.get('end', panel.dates[-1] if panel.dates else None))
+        universe.panel = panel
+        universe.symbol_list_qualified = list(panel.tickers)
+        universe.features = {name: params for name, params in meta.get('features', {}).items() if name in panel.fields}
+        universe.dataframe = None
+        return universe
+
+    # This method opens a universe saved with `save`. The arrays are memory-mapped, so loading is near-instant and several
+    # backtest processes opening the same directory share the data without copying it. A pickle file path is loaded the old way,
+    # and a Parquet file or dataset directory with from_parquet.
+    @classmethod
+    def open(cls, path, mmap_mode='r'):
+        if Path(path).is_file() and Path(path).suffix != '.parquet':
+            return sl.load_dict(path)
+        if Path(path).suffix == '.parquet' or not (Path(path) / 'meta.json').exists():
+            return cls.from_parquet(path)
+        panel, meta = Panel.open(path, mmap_mode=mmap_mode)
+        universe = cls(meta['symbol_list'], start=meta['start'], end=meta['end'])
+        universe.panel = panel
+        universe.symbol_list_qualified = meta['symbol_list_qualified']
+        universe.features = meta.get('features', {})
+        universe.dataframe = None
+        return universe
+
+    # This method returns a registered rolling feature (see features.py) as a wide DataFrame, e.g. U.feature('sharpe_ratio_180')
+    # or U.feature('beta_60', benchmark='BSET100.BK'). The feature is computed for the whole panel at once and attached as a field of that name,
+    # so dict_date[date]['sharpe_ratio_180'] works afterwards and later calls, coordinate() and update() reuse or refresh it.
+    def feature(self, name, **params):
+        if name not in self.panel.fields or self.features.get(name) != params:
+            self.panel.set_field(name, features.compute(self.panel, name, **params))
+            self.features[name] = params
+        return self.panel.frame(name)
+
+    # This method adds or replaces a (date x ticker) field, given as a wide DataFrame or an array, e.g. a rolling statistic computed by a strategy.
+    def set_field(self, name, values):
+        self.panel.set_field(name, values)
+        return
 
     # This method resets the universe by reinitializing the class.
     def clear(self):
         self.__init__(self, self.symbol_list)
         return
 
-    # This method fetches stock data from Yahoo Finance for the specified tickers and date range.
+    # This method fetches stock data for the specified tickers and date range, by default from Yahoo Finance.
+    # Symbols are fetched concurrently with per-symbol retries; pass cache_dir to keep a local cache that only downloads missing dates,
+    # or another DataSource (e.g. datasource.FrameSource) to prepare from local data. Symbols that still fail are listed in self.failed_symbols.
     # It cleans and processes the data, calculates percentage changes, and organizes the data into dictionaries.
-    def prepare(self):
+    def prepare(self, source=None, cache_dir=None, max_workers=8, retries=3, backoff=1.0):
+        source = source or YahooSource()
+        if cache_dir is not None:
+            source = CachedSource(source, cache_dir)
+        data, self.failed_symbols = fetch_many(source, self.symbol_list, self.start, self.end, max_workers=max_workers, retries=retries, backoff=backoff)
+        for failure in self.failed_symbols.values():
+            logging.error(f"{failure['symbol']} skipped after {failure['attempts']} attempts: {failure['error']}")
+
         rawdatalist = []
         for i in self.symbol_list:
-            # Attempt to fetch stock data from Yahoo Finance with retries
-            for attemps in range(3):
-                try:
-                    df = cvx.YahooFinance(i).data
-                    break
-                except Exception as e:
-                    print(e, i, attemps)
+            if i not in data:
+                continue
+            df = data[i]
 
             # Clean and filter the stock data by the date range
             df.index = pd.to_datetime(df.index)
-            cvx_cleaned = df.loc[self.start: self.end]
+            cvx_cleaned = df.loc[self.start: self.end].copy()
             cvx_cleaned['Ticker'] = i
-            self.dict_ticker[i] = cvx_cleaned  # Store data by ticker
 
             # Reset index and process the dataframe
-            cvx_cleaned = cvx_cleaned.reset_index()
-            cvx_cleaned.rename(columns={'index': 'Date'}, inplace=True)
+            cvx_cleaned = cvx_cleaned.rename_axis('Date').reset_index()
             cvx_cleaned['Date'] = cvx_cleaned['Date'].dt.strftime('%Y-%m-%d')
             cvx_cleaned['pctChg'] = cvx_cleaned['close'].pct_change()  # Calculate percentage change
             rawdatalist.append(cvx_cleaned)
 
         # Concatenate all stock data into one dataframe and store it
+        if not rawdatalist:
+            raise ValueError(f"No data could be fetched for any symbol: {self.failed_symbols}")
         DF = pd.concat(rawdatalist, ignore_index=True)
         self.dataframe = DF.set_index(['Date', 'Ticker'])
         self.symbol_list_qualified = list(DF['Ticker'].unique())  # List of qualified tickers
 
-        # Organize the data by date
-        for date in DF['Date'].unique():
-            self.dict_date[date] = self.dataframe.loc[date]
-        
+        # Organize the data by date and by ticker
+        self.panel = Panel.from_frame(DF)
         return
 
 
-    # This method organizes the stock data into dictionaries based on both ticker and date, resetting the dataframe and updating the `dict_ticker` and `dict_date` dictionaries.
-    def coordinate(self):
-        DF = self.dataframe.reset_index()
+    # This method appends the trading days after the last stored date, up to `end` (default: today), instead of re-running prepare() over the whole history.
+    # Only the new bars are fetched, and the derived columns in DERIVED_COLUMNS are recomputed only on the tail of each ticker's history.
+    def update(self, end=None, source=None, cache_dir=None, max_workers=8, retries=3, backoff=1.0):
+        source = source or YahooSource()
+        if cache_dir is not None:
+            source = CachedSource(source, cache_dir)
+        last = self.panel.dates[-1]
+        data, self.failed_symbols = fetch_many(source, self.panel.tickers, last, end, max_workers=max_workers, retries=retries, backoff=backoff)
+        for failure in self.failed_symbols.values():
+            logging.error(f"{failure['symbol']} not updated after {failure['attempts']} attempts: {failure['error']}")
+
+        rawdatalist = []
+        for ticker, df in data.items():
+            df.index = pd.to_datetime(df.index)
+            new_rows = df.rename_axis('Date').reset_index()
+            new_rows['Date'] = new_rows['Date'].dt.strftime('%Y-%m-%d')
+            new_rows['Ticker'] = ticker
+            rawdatalist.append(new_rows[new_rows['Date'] > last])
+        self.end = end or pd.Timestamp.today().strftime('%Y-%m-%d')
+        new_rows = pd.concat(rawdatalist, ignore_index=True) if rawdatalist else pd.DataFrame()
+        if new_rows.empty:
+            return
 
-        # Organize data by ticker
-        for ticker in DF['Ticker'].unique():
-            self.dict_ticker[ticker] = DF[DF['Ticker'] == ticker].set_index('Date')
+        first = self.panel.append(new_rows)
+        self.refresh_tail(first)
+        self.dataframe = None  # Rebuilt from the panel on next access
+        return
 
-        # Organize data by date
-        for date in DF['Date'].unique():
-            self.dict_date[date] = DF[DF['Date'] == date].set_index('Ticker')
-        
-        self.symbol_list = list(DF['Ticker'].unique())  # Update list of tickers
+    # This method recomputes the derived columns and attached features for every row at or after date position `first`, using only as much earlier history as each calculation needs.
+    def refresh_tail(self, first):
+        panel = self.panel
+        for name, (lookback, func) in DERIVED_COLUMNS.items():
+            if name not in panel.fields:
+                continue
+            array = np.array(panel.fields[name], dtype=float)
+            for j in range(len(panel.tickers)):
+                rows = np.flatnonzero(panel.present[:, j])
+                count = int((rows >= first).sum())
+                if count == 0:
+                    continue
+                rows = rows[max(0, len(rows) - count - lookback):]
+                frame = pd.DataFrame({field: values[rows, j] for field, values in panel.fields.items()})
+                array[rows[-count:], j] = func(frame).to_numpy()[-count:]
+            panel.set_field(name, array)
+
+        # Attached features are recomputed from the first date that still gives every ticker a full window before its new rows.
+        for name, params in self.features.items():
+            lookback = features.parse(name)[1] - 1
+            start = first
+            if lookback > 0 and first > 0:
+                before = np.asarray(panel.present[:first])
+                reached = np.cumsum(before[::-1], axis=0) >= lookback
+                earliest = np.where(before.any(axis=0), before.argmax(axis=0), first)
+                starts = np.where(reached.any(axis=0), first - 1 - reached.argmax(axis=0), earliest)
+                has_new = np.asarray(panel.present[first:]).any(axis=0)
+                start = int(starts[has_new].min()) if has_new.any() else first
+            tail = Panel(panel.dates[start:], panel.tickers, {field: values[start:] for field, values in panel.fields.items()}, panel.present[start:])
+            array = np.array(panel.fields[name], dtype=float)
+            array[first:] = features.compute(tail, name, **params)[first - start:]
+            panel.set_field(name, array)
+        return
+
+    # This method rebuilds the panel behind `dict_ticker` and `dict_date` from the dataframe, e.g. after new columns were added to it.
+    # It is a single pass over the rows instead of one boolean mask per date and per ticker.
+    def coordinate(self):
+        self.panel = Panel.from_frame(self.dataframe)
+        for name, params in self.features.items():
+            self.panel.set_field(name, features.compute(self.panel, name, **params))
+        self.symbol_list = list(self.panel.tickers)  # Update list of tickers
         self.symbol_list_qualified = self.symbol_list  # Update list of qualified tickers
         return
     
 
-        
+
+# This function converts a pickled Universe (written by sl.save_dict) into the directory format and returns it opened from disk.
+def migrate(pickle_path, path):
+    universe = sl.load_dict(pickle_path)
+    universe.save(path)
+    return Universe.open(path)
+
+
 if __name__ == '__main__':
     # This is a test to generate a universe
     df = sl.read_csv('symbol_list_correct.csv')
@@ -103,5 +296,6 @@ if __name__ == '__main__':
     U_new = Universe(symbol_list=filtered_tickers)
     U_new.prepare()
     sl.save_dict(U_new, 'U1_test.pkl')
+    U_new.save('U1_test')  # Memory-mapped copy, open it with Universe.open('U1_test')
     
         
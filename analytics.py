@@ -0,0 +1,190 @@
+import warnings
+import numpy as np
+import pandas as pd
+import features
+
+##################################################################################
+# This module computes performance analytics for one or many equity curves at once.
+# Curves are given as a DataFrame (dates x curves, e.g. the curves returned by sweep.sweep), a Series, a {date: value} dictionary
+# or an array, and every calculation is a single pass of array operations over all of them. Curves of different lengths are
+# padded with NaN and each statistic uses the valid values of its own curve.
+# Weights are (dates x tickers) arrays for one curve, or (curves x dates x tickers) for many.
+##################################################################################
+
+PERIODS_PER_YEAR = 252
+
+
+# This function returns the curves as a float DataFrame with one column per curve.
+def curve_frame(values):
+    if isinstance(values, dict):
+        values = pd.Series(values)
+    if isinstance(values, pd.Series):
+        values = values.to_frame()
+    if not isinstance(values, pd.DataFrame):
+        array = np.asarray(values, dtype=float)
+        values = pd.DataFrame(array.reshape(len(array), -1))
+    return values.astype(float)
+
+
+# This function returns period returns (the first row is NaN).
+def returns(values):
+    v = curve_frame(values)
+    array = v.to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = np.vstack([np.full((1, array.shape[1]), np.nan), array[1:] / array[:-1] - 1])
+    return pd.DataFrame(r, index=v.index, columns=v.columns)
+
+
+# This function returns the drawdown of every curve from its running high-water mark, as a fraction (0 at a new high).
+def drawdown(values):
+    v = curve_frame(values)
+    array = v.to_numpy()
+    hwm = np.fmax.accumulate(array, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return pd.DataFrame(1 - array / hwm, index=v.index, columns=v.columns)
+
+
+# This function returns the number of periods since each curve last set a high-water mark (0 at a new high).
+def drawdown_duration(values):
+    v = curve_frame(values)
+    array = v.to_numpy()
+    at_high = array >= np.fmax.accumulate(array, axis=0)
+    position = np.arange(len(array))[:, None]
+    last_high = np.maximum.accumulate(np.where(at_high, position, 0), axis=0)
+    duration = np.where(np.isnan(array), np.nan, position - last_high)
+    return pd.DataFrame(duration, index=v.index, columns=v.columns)
+
+
+# This function returns the annualized rolling volatility of returns over `window` periods.
+def rolling_volatility(values, window=63, periods=PERIODS_PER_YEAR):
+    r = returns(values)
+    return pd.DataFrame(features.rolling_std(r.to_numpy(), window) * np.sqrt(periods), index=r.index, columns=r.columns)
+
+
+# This function returns the annualized rolling Sharpe ratio over `window` periods, in excess of an annual risk-free rate.
+def rolling_sharpe(values, window=63, risk_free=0.02, periods=PERIODS_PER_YEAR):
+    r = returns(values)
+    excess = r.to_numpy() - ((1 + risk_free)**(1 / periods) - 1)
+    std = features.rolling_std(excess, window)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sharpe = np.where(std > 0, features.rolling_mean(excess, window) / std, np.nan) * np.sqrt(periods)
+    return pd.DataFrame(sharpe, index=r.index, columns=r.columns)
+
+
+# This function returns the annualized rolling Sortino ratio: the mean excess return over the root mean square of the negative excess returns.
+def rolling_sortino(values, window=63, risk_free=0.02, periods=PERIODS_PER_YEAR):
+    r = returns(values)
+    excess = r.to_numpy() - ((1 + risk_free)**(1 / periods) - 1)
+    downside = np.sqrt(features.rolling_mean(np.minimum(excess, 0)**2, window))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sortino = np.where(downside > 0, features.rolling_mean(excess, window) / downside, np.nan) * np.sqrt(periods)
+    return pd.DataFrame(sortino, index=r.index, columns=r.columns)
+
+
+# This function returns the turnover of every period, the sum of absolute weight changes, from a weight history.
+# The first period counts the trades that build the initial positions.
+def turnover(weights):
+    w = np.asarray(weights, dtype=float)
+    previous = np.concatenate([np.zeros_like(w[..., :1, :]), w[..., :-1, :]], axis=-2)
+    return np.nansum(np.abs(w - previous), axis=-1)
+
+
+# This function returns the gross, net, long and short exposure of every period from a weight history.
+def exposure(weights):
+    w = np.nan_to_num(np.asarray(weights, dtype=float))
+    long = np.where(w > 0, w, 0).sum(axis=-1)
+    short = np.where(w < 0, -w, 0).sum(axis=-1)
+    return {'gross': long + short, 'net': long - short, 'long': long, 'short': short}
+
+
+# This function returns, per curve, the share of periods with a positive return among the periods with a non-zero return.
+def hit_rate(values):
+    r = returns(values).to_numpy()
+    traded = ~np.isnan(r) & (r != 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return pd.Series((r > 0).sum(axis=0) / traded.sum(axis=0), index=curve_frame(values).columns)
+
+
+# This function regresses the returns of every curve on the returns of a benchmark (a value series such as an index level, aligned by date).
+# It returns a DataFrame with the annualized alpha and the beta of each curve, using the periods where both returns exist.
+def alpha_beta(values, benchmark, periods=PERIODS_PER_YEAR):
+    r = returns(values)
+    b = returns(pd.Series(benchmark).reindex(r.index)).to_numpy()
+    x = np.broadcast_to(b, r.shape)
+    y = r.to_numpy()
+    valid = ~np.isnan(x) & ~np.isnan(y)
+    count = valid.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_mean = np.where(valid, x, 0).sum(axis=0) / count
+        y_mean = np.where(valid, y, 0).sum(axis=0) / count
+        x0 = np.where(valid, x - x_mean, 0)
+        y0 = np.where(valid, y - y_mean, 0)
+        beta = (x0 * y0).sum(axis=0) / (x0 * x0).sum(axis=0)
+    alpha = (y_mean - beta * x_mean) * periods
+    return pd.DataFrame({'alpha': alpha, 'beta': beta}, index=r.columns)
+
+
+# This function returns one row of headline statistics per curve:
+# sharpe, sortino, volatility, cagr, total_return, max_drawdown, average_drawdown, max_drawdown_duration and hit_rate,
+# plus alpha and beta with a benchmark, and mean turnover and gross/net exposure with weights.
+# sharpe follows BacktestModule.statistics: mean excess return over the population std of returns, annualized.
+# Statistics of a curve without enough valid values (e.g. a run whose cash went to NaN) are NaN.
+def summary(values, benchmark=None, weights=None, risk_free=0.02, periods=PERIODS_PER_YEAR):
+    v = curve_frame(values)
+    array = v.to_numpy()
+    r = returns(v).to_numpy()
+    excess = r - ((1 + risk_free)**(1 / periods) - 1)
+    valid = ~np.isnan(array)
+    count = valid.sum(axis=0)
+    first = np.take_along_axis(array, valid.argmax(axis=0)[None], axis=0)[0]
+    last = np.take_along_axis(array, (len(array) - 1 - valid[::-1].argmax(axis=0))[None], axis=0)[0]
+    dd = drawdown(v).to_numpy()
+
+    with np.errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # Empty slices of all-NaN curves
+        std = np.nanstd(r, axis=0)
+        downside = np.sqrt(np.nanmean(np.minimum(excess, 0)**2, axis=0))
+        total_return = last / first
+        stats = pd.DataFrame({'sharpe': np.nanmean(excess, axis=0) / std * np.sqrt(periods),
+                              'sortino': np.nanmean(excess, axis=0) / downside * np.sqrt(periods),
+                              'volatility': std * np.sqrt(periods),
+                              'cagr': total_return**(periods / count) - 1,
+                              'total_return': total_return - 1,
+                              'max_drawdown': np.nanmax(dd, axis=0),
+                              'average_drawdown': np.nanmean(dd, axis=0),
+                              'max_drawdown_duration': np.nanmax(drawdown_duration(v).to_numpy(), axis=0),
+                              'hit_rate': hit_rate(v).to_numpy()},
+                             index=v.columns)
+    if benchmark is not None:
+        stats = stats.join(alpha_beta(v, benchmark, periods))
+    if weights is not None:
+        w = np.asarray(weights, dtype=float)
+        if w.ndim == 2:
+            w = w[None]
+        gross = exposure(w)
+        stats['turnover'] = turnover(w).mean(axis=-1)
+        stats['gross_exposure'] = gross['gross'].mean(axis=-1)
+        stats['net_exposure'] = gross['net'].mean(axis=-1)
+    return stats
+
+
+# This function runs every analytic at once and returns a dictionary of results:
+# 'summary' (one row per curve), the (dates x curves) frames 'drawdown', 'drawdown_duration', 'rolling_volatility',
+# 'rolling_sharpe' and 'rolling_sortino', and with weights the (dates x curves) frames 'turnover', 'gross_exposure' and 'net_exposure'.
+def analyze(values, benchmark=None, weights=None, window=63, risk_free=0.02, periods=PERIODS_PER_YEAR):
+    v = curve_frame(values)
+    result = {'summary': summary(v, benchmark, weights, risk_free, periods),
+              'drawdown': drawdown(v),
+              'drawdown_duration': drawdown_duration(v),
+              'rolling_volatility': rolling_volatility(v, window, periods),
+              'rolling_sharpe': rolling_sharpe(v, window, risk_free, periods),
+              'rolling_sortino': rolling_sortino(v, window, risk_free, periods)}
+    if weights is not None:
+        w = np.asarray(weights, dtype=float)
+        if w.ndim == 2:
+            w = w[None]
+        gross = exposure(w)
+        result['turnover'] = pd.DataFrame(turnover(w).T, index=v.index, columns=v.columns)
+        result['gross_exposure'] = pd.DataFrame(gross['gross'].T, index=v.index, columns=v.columns)
+        result['net_exposure'] = pd.DataFrame(gross['net'].T, index=v.index, columns=v.columns)
+    return result
@@ -0,0 +1,143 @@
+import numpy as np
+import pandas as pd
+import features
+import analytics
+import schedule
+from panel import Panel
+from sizing import weight_matrix
+from BT import COST_FIELDS, make_cost_model, cost_coefficients
+
+##################################################################################
+# This module backtests many strategies on one universe in a single pass. The positions of K strategies are stacked into a
+# (strategies x dates x tickers) weight tensor and simulated together, so prices, returns and cost inputs are looked up once
+# and every step works on all strategies at once. It gives the same portfolio values as BacktestModule(engine='vectorized')
+# run on each strategy separately.
+# Strategies can also be blended into a meta-portfolio with fixed allocations. The blend trades the net of its sleeves, so
+# trades in opposite directions cancel out before costs; netting() reports how much turnover that saves. Between its trade dates
+# the blend holds what it bought, marked to the daily returns, so its sleeves are not rebalanced against each other for free.
+##################################################################################
+
+
+# This class simulates several strategies on the same universe and dates.
+# strategies is a {name: strategy} dictionary or a list, where each strategy is a calculated myStrategy or a (dates x tickers)
+# DataFrame of weights. blend is an optional {name: allocation} dictionary: the blended portfolio holds the sum of allocation * sleeve
+# weights and is simulated as one more strategy, named 'blend'. The other arguments are those of BacktestModule.
+class BatchBacktest:
+    def __init__(self, universe, strategies, t_cost=['default'], start=None, end=None, holding_feerate=0.03, initial_cash=100_0000, blend=None):
+        if not isinstance(strategies, dict):
+            strategies = dict(enumerate(strategies))
+        self.UNI = universe
+        self.strategies = strategies
+        self.names = list(strategies) + (['blend'] if blend else [])
+        self.blend = blend
+        self.dates = [date for date in universe.panel.dates if date >= start and date <= end]
+        self.tcost_model = t_cost
+        self.cost_model = make_cost_model(t_cost)
+        self.holding_feerate = holding_feerate
+        self.initial_cash = initial_cash
+        self.start = start
+        self.end = end
+        self.weights = None  # (strategies x dates x tickers) weights, set by run
+        self.tickers = None  # Tickers of the weight columns
+        self.traded = None  # (strategies x dates) turnover
+        self.portfolio_value = None  # (dates x strategies) DataFrame of portfolio values
+
+    # This method stacks the positions of the strategies into a (strategies x dates x tickers) tensor over all universe tickers, with a
+    # (strategies x dates) boolean array of trade dates for strategies with a rebalance schedule (all True for the others),
+    # and a boolean array of the strategies that have one.
+    def stack(self):
+        tickers = self.UNI.panel.tickers
+        weights = np.zeros((len(self.names), len(self.dates), len(tickers)))
+        trade_days = np.ones((len(self.names), len(self.dates)), dtype=bool)
+        scheduled = np.zeros(len(self.names), dtype=bool)
+        for k, strategy in enumerate(self.strategies.values()):
+            if isinstance(strategy, pd.DataFrame):
+                weights[k] = strategy.reindex(index=self.dates, columns=tickers).fillna(0).to_numpy(dtype=float)
+                continue
+            weights[k] = weight_matrix(strategy.position_dict, self.dates, tickers)
+            if strategy.rebalance_dates is not None:
+                trade_days[k] = np.isin(self.dates, strategy.rebalance_dates)
+                scheduled[k] = True
+        if self.blend:
+            # The blend trades whenever one of its sleeves does, and holds between dates when none of them trades
+            sleeves = [list(self.strategies).index(name) for name in self.blend]
+            allocation = np.array(list(self.blend.values()), dtype=float)
+            weights[-1] = np.tensordot(allocation, weights[sleeves], axes=1)
+            scheduled[-1] = scheduled[sleeves].all()
+            trade_days[-1] = trade_days[sleeves].any(axis=0)
+            trade_days[-1, :1] = True
+            if scheduled[-1]:
+                returns = np.asarray(self.UNI.panel.matrix('pctChg', self.dates, tickers), dtype=float)
+                rows = np.append(np.flatnonzero(trade_days[-1]), len(self.dates))
+                for row, stop in zip(rows[:-1], rows[1:]):
+                    weights[-1, row + 1:stop] = schedule.mark(weights[-1, row], returns[row + 1:stop])
+        trade_days[:, :1] = True
+        return weights, trade_days, scheduled
+
+    # This method runs the simulation and returns the (dates x strategies) portfolio values.
+    def run(self):
+        weights, trade_days, scheduled = self.stack()
+        held = np.flatnonzero((weights != 0).any(axis=(0, 1)))
+        tickers = [self.UNI.panel.tickers[j] for j in held]
+        weights = weights[:, :, held]
+        panel = self.UNI.panel
+        fields = {field: np.asarray(panel.matrix(field, self.dates, tickers), dtype=float) for field in COST_FIELDS if field in panel.fields}
+        if 'rolling_std' not in fields:
+            # As in BacktestModule, the 180-day rolling std of close stands in for a missing rolling_std column
+            rolling_std = panel.fields['rolling_std_180'] if 'rolling_std_180' in panel.fields else features.compute(panel, 'rolling_std_180')
+            fields['rolling_std'] = np.asarray(rolling_std)[np.ix_(Panel.positions(panel.date_index, self.dates), held)]
+
+        prev_weights = np.concatenate([np.zeros_like(weights[:, :1]), weights[:, :-1]], axis=1)
+        returns = np.where(prev_weights != 0, prev_weights * fields['pctChg'], 0).sum(axis=2)
+        holding = np.where(prev_weights < 0, -prev_weights, 0).sum(axis=2) * ((1 + self.holding_feerate)**(1/252) - 1)
+
+        # Trades of scheduled strategies start from the holdings marked to the day's returns, and only happen on trade dates
+        marked = np.where(trade_days[:, :, None], schedule.mark_day(prev_weights, fields['pctChg']), weights)
+        before = np.where(scheduled[:, None, None], marked, prev_weights)
+        A, B = cost_coefficients(self.tcost_model, weights, before, fields['close'], fields['valuevolume'], fields['rolling_std'])
+        traded = np.abs(weights - before)
+        touched = np.where(scheduled[:, None, None], traded != 0, (weights != 0) | (prev_weights != 0))
+
+        cash = np.full(len(self.names), float(self.initial_cash))
+        values = np.zeros((len(self.dates), len(self.names)))
+        for i in range(len(self.dates)):
+            alive = ~np.isnan(cash) & (cash != 0)
+            if A is not None:
+                transaction_cost = A[:, i] * cash + B[:, i] * cash**1.5
+            else:
+                data = {field: fields[field][i] for field in COST_FIELDS}
+                transaction_cost = np.where(touched[:, i], self.cost_model(traded[:, i] * cash[:, None], data), 0).sum(axis=1)
+            cash = np.where(alive, np.maximum(cash + cash * (returns[:, i] - holding[:, i]) - transaction_cost, 0), cash)
+            values[i] = np.where(alive, cash, 0)
+
+        index = self.dates if self.start in self.dates or not self.dates else [self.start] + self.dates
+        values = np.vstack([np.full((len(index) - len(self.dates), len(self.names)), float(self.initial_cash)), values])
+        self.portfolio_value = pd.DataFrame(values, index=index, columns=self.names)
+        self.weights = weights
+        self.tickers = tickers
+        self.traded = traded.sum(axis=2)
+        return self.portfolio_value
+
+    # This method returns one row of statistics per strategy (see analytics.summary).
+    def summary(self, benchmark=None):
+        weights = self.weights
+        if len(self.portfolio_value) > len(self.dates):
+            weights = np.concatenate([np.zeros_like(weights[:, :1]), weights], axis=1)
+        return analytics.summary(self.portfolio_value, benchmark=benchmark, weights=weights)
+
+    # This method returns the daily turnover of the blend against the allocation-weighted turnover of its sleeves traded separately,
+    # as a (dates x ['sleeves', 'blend', 'netted']) DataFrame; netted is the turnover saved by trading the net of the sleeves.
+    def netting(self):
+        if not self.blend:
+            raise ValueError("netting needs a blend of strategies")
+        sleeves = [list(self.strategies).index(name) for name in self.blend]
+        allocation = np.abs(np.array(list(self.blend.values()), dtype=float))
+        separate = allocation @ self.traded[sleeves]
+        return pd.DataFrame({'sleeves': separate, 'blend': self.traded[-1], 'netted': separate - self.traded[-1]}, index=self.dates)
+
+
+# This function runs a BatchBacktest and returns it; see BatchBacktest for the arguments.
+def run_batch(universe, strategies, start, end, **kwargs):
+    batch = BatchBacktest(universe, strategies, start=start, end=end, **kwargs)
+    batch.run()
+    return batch
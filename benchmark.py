@@ -0,0 +1,186 @@
+import argparse
+import contextlib
+import io
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from Universe import Universe
+from strategy import myStrategy
+from BT import BacktestModule
+import features
+
+##################################################################################
+# This module benchmarks the main stages of a backtest on synthetic universes of any size, without downloading data.
+# Each stage (Universe.coordinate, myStrategy.calculate, BacktestModule.run_backtest, BacktestModule.statistics) is timed,
+# then run again under tracemalloc for its peak memory. Results are written as JSON, so runs of two versions can be compared.
+#
+#   python benchmark.py --tickers 20 200 2000 --years 1 5 20 --output bench.json
+#   python benchmark.py --tickers 20 200 --years 1 5 --output new.json --baseline bench.json
+##################################################################################
+
+TRADING_DAYS = 252
+STAGES = ('coordinate', 'calculate', 'run_backtest', 'statistics')
+
+
+# This function generates a synthetic universe as a long dataframe indexed by (Date, Ticker), in the layout of Universe.dataframe:
+# open, high, low, close, volume, return, valuevolume plus the derived pctChg, rolling_std and sharpe_ratio of dict_ticker.
+# Prices follow geometric random walks. With gap_frac > 0, that share of rows is dropped at random to mimic suspensions and late listings.
+def synthetic_frame(n_tickers, n_days, seed=0, start='2000-01-03', gap_frac=0.0):
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range(start, periods=n_days).strftime('%Y-%m-%d')
+    tickers = [f'S{j:04d}.BK' for j in range(n_tickers)]
+    drift = rng.normal(0.0003, 0.0003, n_tickers)
+    vol = rng.uniform(0.01, 0.03, n_tickers)
+    returns = rng.normal(drift, vol, (n_days, n_tickers))
+    close = 10 * rng.uniform(0.5, 5, n_tickers) * np.exp(np.cumsum(returns, axis=0))
+    spread = np.abs(rng.normal(0, vol / 2, (n_days, n_tickers)))
+    volume = rng.lognormal(13, 1, (n_days, n_tickers)).round()
+    simple_return = np.vstack([np.full((1, n_tickers), np.nan), close[1:] / close[:-1] - 1])
+    std = features.rolling_std(simple_return, 180)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sharpe = np.where(std > 0, features.rolling_mean(simple_return, 180) / std, np.nan)
+    fields = {'open': close * np.exp(rng.normal(0, vol / 4, (n_days, n_tickers))),
+              'high': close * (1 + spread),
+              'low': close * (1 - spread),
+              'close': close,
+              'volume': volume,
+              'return': simple_return,
+              'valuevolume': volume * close,
+              'pctChg': simple_return,
+              'rolling_std': features.rolling_std(close, 180),
+              'sharpe_ratio': sharpe}
+    keep = rng.random((n_days, n_tickers)) >= gap_frac
+    date_pos, ticker_pos = np.nonzero(keep)
+    index = pd.MultiIndex.from_arrays([np.asarray(dates, dtype=object)[date_pos], np.asarray(tickers, dtype=object)[ticker_pos]], names=['Date', 'Ticker'])
+    return pd.DataFrame({name: array[date_pos, ticker_pos] for name, array in fields.items()}, index=index)
+
+
+# This function returns an uncoordinated Universe holding a synthetic dataframe; call coordinate() to build its panel.
+def synthetic_universe(n_tickers, n_days, seed=0, gap_frac=0.0):
+    df = synthetic_frame(n_tickers, n_days, seed=seed, gap_frac=gap_frac)
+    dates = df.index.get_level_values('Date')
+    universe = Universe(list(df.index.get_level_values('Ticker').unique()), start=dates[0], end=dates[-1])
+    universe.dataframe = df
+    return universe
+
+
+# This function runs a stage once for its wall time, then once more under tracemalloc for its peak memory above the starting point.
+# It returns (seconds, peak_mb, result of the timed run).
+def measure(stage, memory=True):
+    start = time.perf_counter()
+    result = stage()
+    seconds = time.perf_counter() - start
+    peak_mb = None
+    if memory:
+        tracemalloc.start()
+        try:
+            baseline = tracemalloc.get_traced_memory()[0]
+            stage()
+            peak_mb = (tracemalloc.get_traced_memory()[1] - baseline) / 2**20
+        finally:
+            tracemalloc.stop()
+    return seconds, peak_mb, result
+
+
+# This function benchmarks every stage on one synthetic universe and returns one record per stage.
+def run_size(n_tickers, n_years, engine='loop', memory=True, seed=0, gap_frac=0.0, strategy_kwargs=None):
+    n_days = int(n_years * TRADING_DAYS)
+    universe = synthetic_universe(n_tickers, n_days, seed=seed, gap_frac=gap_frac)
+    start, end = universe.start, universe.end
+
+    def calculate():
+        S = myStrategy(Universe=universe, start=start, end=end, **(strategy_kwargs or {}))
+        S.calculate()
+        return S
+
+    def run_backtest():
+        backtest = BacktestModule(strategy, start=start, end=end, engine=engine)
+        backtest.run_backtest()
+        return backtest
+
+    def statistics():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return backtest.statistics()
+
+    records = []
+    base = {'n_tickers': n_tickers, 'n_years': n_years, 'n_days': n_days, 'rows': len(universe.dataframe), 'engine': engine}
+    stages = {'coordinate': universe.coordinate, 'calculate': calculate, 'run_backtest': run_backtest, 'statistics': statistics}
+    for name in STAGES:
+        seconds, peak_mb, result = measure(stages[name], memory=memory)
+        if name == 'calculate':
+            strategy = result
+        elif name == 'run_backtest':
+            backtest = result
+        records.append(dict(base, stage=name, seconds=seconds, peak_mb=peak_mb))
+    return records
+
+
+# This function describes the environment of a run, so results from different versions and machines can be told apart.
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'timestamp': pd.Timestamp.now().isoformat(timespec='seconds'),
+            'git_commit': commit,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'machine': platform.platform()}
+
+
+# This function runs the benchmark over every combination of ticker and year counts and returns {'environment': ..., 'results': [...]}.
+# With output, the report is also written there as JSON.
+def run(tickers=(20, 200, 2000), years=(1, 5, 20), engine='loop', memory=True, seed=0, gap_frac=0.0, output=None):
+    results = []
+    for n_tickers in tickers:
+        for n_years in years:
+            results.extend(run_size(n_tickers, n_years, engine=engine, memory=memory, seed=seed, gap_frac=gap_frac))
+    report = {'environment': environment(), 'results': results}
+    if output is not None:
+        with open(output, 'w') as file:
+            json.dump(report, file, indent=1)
+    return report
+
+
+# This function compares two reports (dicts or JSON paths) stage by stage. ratio is current / baseline time,
+# and a stage is flagged as a regression when it is more than `tolerance` slower (0.25 = 25%) and more than min_delta seconds slower,
+# so stages that take microseconds do not flag on noise.
+def compare(baseline, current, tolerance=0.25, min_delta=0.01):
+    frames = []
+    for report in (baseline, current):
+        if not isinstance(report, dict):
+            with open(report) as file:
+                report = json.load(file)
+        frames.append(pd.DataFrame(report['results']))
+    keys = ['stage', 'n_tickers', 'n_years', 'engine']
+    merged = frames[0].merge(frames[1], on=keys, suffixes=('_baseline', '_current'))
+    merged['ratio'] = merged['seconds_current'] / merged['seconds_baseline']
+    merged['regression'] = (merged['ratio'] > 1 + tolerance) & (merged['seconds_current'] - merged['seconds_baseline'] > min_delta)
+    return merged[keys + ['seconds_baseline', 'seconds_current', 'ratio', 'peak_mb_baseline', 'peak_mb_current', 'regression']]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark Universe.coordinate, myStrategy.calculate and BacktestModule on synthetic data.')
+    parser.add_argument('--tickers', type=int, nargs='+', default=[20, 200, 2000])
+    parser.add_argument('--years', type=float, nargs='+', default=[1, 5, 20])
+    parser.add_argument('--engine', default='loop', choices=['loop', 'vectorized'])
+    parser.add_argument('--no-memory', action='store_true', help='Skip the tracemalloc run of each stage')
+    parser.add_argument('--gap-frac', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--baseline', help='Report of an earlier run to compare against')
+    args = parser.parse_args()
+
+    report = run(args.tickers, args.years, engine=args.engine, memory=not args.no_memory, seed=args.seed, gap_frac=args.gap_frac, output=args.output)
+    print(pd.DataFrame(report['results']).to_string(index=False))
+    if args.baseline:
+        comparison = compare(args.baseline, report)
+        print(comparison.to_string(index=False))
+        if comparison['regression'].any():
+            raise SystemExit(1)
@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+import features
+
+##################################################################################
+# This module estimates rolling CAPM alpha and beta of every ticker against a benchmark, for several window lengths at once.
+# All windows come from one set of cumulative sums (features.rolling_regression) instead of one regression per ticker and window.
+# The estimates are used in two ways:
+#   - as panel fields for myStrategy scores: attach(U, [60, 252]) adds alpha_60, beta_60, alpha_252 and beta_252,
+#     then myStrategy(U, score='alpha_60') selects on them;
+#   - as a cvxportfolio returns forecaster: cvx.ReturnsForecast(r_hat=CAPMForecaster(252)), in place of the CustomForecaster
+#     of market-neutral.ipynb.
+##################################################################################
+
+BENCHMARK = 'BSET100.BK'
+
+
+# This function adds the rolling alpha_<window> and beta_<window> fields of every ticker to the universe, for all windows in one pass.
+# They are registered like Universe.feature results, so coordinate() and update() keep them current.
+def attach(universe, windows, benchmark=BENCHMARK, field='return'):
+    panel = universe.panel
+    x = np.asarray(panel.matrix(field), dtype=float)
+    fits = features.rolling_regression(x, features.benchmark_column(panel, field, benchmark), windows)
+    params = {'field': field, 'benchmark': benchmark}
+    for window, (alpha, beta) in fits.items():
+        for name, values in ((f'alpha_{window}', alpha), (f'beta_{window}', beta)):
+            universe.set_field(name, values)
+            universe.features[name] = params
+    return
+
+
+# This class estimates alpha and beta for several windows from a cvxportfolio past_returns frame (dates x assets, cash last).
+# It keeps the estimates of the last date it saw, so several forecasters sharing one model (e.g. one per window of a
+# MultiPeriodOptimization sweep) compute them once per simulation step.
+class CAPMModel:
+    def __init__(self, windows, benchmark=BENCHMARK):
+        self.windows = sorted(set(windows))
+        self.benchmark = benchmark
+        self.key = None
+        self.estimates = {}  # window -> (alpha, beta, mean benchmark return) as of the last date seen
+
+    def estimate(self, past_returns):
+        key = (past_returns.index[-1], past_returns.shape)
+        if key != self.key:
+            tail = past_returns.iloc[-max(self.windows):]
+            y = tail.iloc[:, :-1].to_numpy(dtype=float)
+            x = tail[self.benchmark].to_numpy(dtype=float)[:, None]
+            fits = features.rolling_regression(y, x, self.windows)
+            self.estimates = {window: (alpha[-1], beta[-1], np.mean(x[-window:])) for window, (alpha, beta) in fits.items()}
+            self.key = key
+        return self.estimates
+
+    def forecaster(self, window, use_alpha=False):
+        if window not in self.windows:
+            self.windows = sorted(self.windows + [window])
+            self.key = None
+        return CAPMForecaster(window, model=self, use_alpha=use_alpha)
+
+
+# This class is a cvxportfolio returns forecaster: r_hat = beta * mean benchmark return over the window, plus alpha with use_alpha=True.
+# Assets with less than a full window of returns get NaN.
+# Pass model=CAPMModel([...]) to share the estimation between forecasters of different windows.
+class CAPMForecaster:
+    def __init__(self, window=252, benchmark=BENCHMARK, use_alpha=False, model=None):
+        self.window = window
+        self.use_alpha = use_alpha
+        self.model = model if model is not None else CAPMModel([window], benchmark)
+
+    # This method returns the alpha and beta of every asset, as two Series indexed like the asset columns of past_returns.
+    def CAPM_regression(self, past_returns):
+        alpha, beta, _ = self.model.estimate(past_returns)[self.window]
+        assets = past_returns.columns[:-1]
+        return pd.Series(alpha, index=assets), pd.Series(beta, index=assets)
+
+    def values_in_time(self, past_returns, **kwargs):
+        alpha, beta, market = self.model.estimate(past_returns)[self.window]
+        forecast = beta * market + (alpha if self.use_alpha else 0)
+        return pd.Series(forecast, index=past_returns.columns[:-1])
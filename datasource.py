@@ -0,0 +1,105 @@
+import concurrent.futures
+import json
+import logging
+import time
+from pathlib import Path
+import cvxportfolio as cvx
+import pandas as pd
+
+
+# This class is the interface for market data providers used by Universe.prepare.
+# fetch(symbol, start, end) returns the daily bars of one symbol as a DataFrame indexed by date, in the layout of cvx.YahooFinance(symbol).data
+# (open, high, low, close, volume, return, valuevolume). A None bound means the full history on that side. Failures are raised as exceptions.
+class DataSource:
+    def fetch(self, symbol, start=None, end=None):
+        raise NotImplementedError
+
+
+# This provider downloads from Yahoo Finance through cvxportfolio, which is what Universe.prepare has always used.
+class YahooSource(DataSource):
+    def fetch(self, symbol, start=None, end=None):
+        df = cvx.YahooFinance(symbol).data
+        df.index = pd.to_datetime(df.index)
+        return df.loc[start: end]
+
+
+# This provider serves data from local DataFrames, e.g. {'PTT.BK': df}. Use it in tests or offline instead of YahooSource.
+class FrameSource(DataSource):
+    def __init__(self, frames):
+        self.frames = frames
+
+    def fetch(self, symbol, start=None, end=None):
+        df = self.frames[symbol]
+        df = df.set_axis(pd.to_datetime(df.index))
+        return df.loc[start: end]
+
+
+# This class wraps another provider with an on-disk cache of one file per symbol.
+# It remembers the date range already fetched for each symbol and only asks the wrapped provider for the part that is missing.
+class CachedSource(DataSource):
+    def __init__(self, source, cache_dir='yahoo_cache'):
+        self.source = source
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def fetch(self, symbol, start=None, end=None):
+        data_file = self.cache_dir / f'{symbol}.pkl'
+        range_file = self.cache_dir / f'{symbol}.json'
+        if not data_file.exists() or not range_file.exists():
+            df = self.source.fetch(symbol, start, end)
+            self.write(symbol, df, start, self.last_date(df, end))
+            return df
+
+        df = pd.read_pickle(data_file)
+        with open(range_file) as file:
+            covered = json.load(file)
+        pieces = [df]
+        # Fetch what lies before the covered range, then what lies after it. Both pieces overlap the cache by one bound, which is deduplicated below.
+        if covered['start'] is not None and (start is None or pd.Timestamp(start) < pd.Timestamp(covered['start'])):
+            pieces.insert(0, self.source.fetch(symbol, start, covered['start']))
+            covered['start'] = start
+        # The cache covers up to the last date fetched: an open end always fetches what came after it
+        if covered['end'] is None or end is None or pd.Timestamp(end) > pd.Timestamp(covered['end']):
+            pieces.append(self.source.fetch(symbol, covered['end'] if covered['end'] is not None else start, end))
+            covered['end'] = end
+        if len(pieces) > 1:
+            df = pd.concat(pieces)
+            df = df[~df.index.duplicated(keep='last')].sort_index()
+            self.write(symbol, df, covered['start'], self.last_date(df, covered['end']))
+        return df.loc[start: end]
+
+    # This method returns the end of the range a fetch covers: `end`, or the last date of the data when the fetch had no end.
+    @staticmethod
+    def last_date(df, end):
+        if end is not None or len(df) == 0:
+            return end
+        return pd.Timestamp(df.index.max()).strftime('%Y-%m-%d')
+
+    def write(self, symbol, df, start, end):
+        df.to_pickle(self.cache_dir / f'{symbol}.pkl')
+        with open(self.cache_dir / f'{symbol}.json', 'w') as file:
+            json.dump({'start': start, 'end': end}, file)
+        return
+
+
+# This function fetches many symbols concurrently with a bounded thread pool. Each symbol is retried with exponential backoff.
+# It returns ({symbol: DataFrame}, {symbol: {'symbol', 'attempts', 'error'}}) so failed symbols are reported instead of raising.
+def fetch_many(source, symbols, start=None, end=None, max_workers=8, retries=3, backoff=1.0):
+    def fetch_one(symbol):
+        error = None
+        for attempt in range(retries):
+            try:
+                return source.fetch(symbol, start, end), None
+            except Exception as e:
+                error = e
+                logging.warning(f"Fetching {symbol} failed on attempt {attempt + 1}: {e}")
+                if attempt < retries - 1:
+                    time.sleep(backoff * 2**attempt)
+        return None, {'symbol': symbol, 'attempts': retries, 'error': f'{type(error).__name__}: {error}'}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = dict(zip(symbols, executor.map(fetch_one, symbols)))
+
+    data = {symbol: df for symbol, (df, failure) in results.items() if failure is None}
+    failures = {symbol: failure for symbol, (df, failure) in results.items() if failure is not None}
+    return data, failures
@@ -54,7 +54,11 @@ def process(code):
     if len(data)<1595:  #change this according to your chosen time span
         logging.error(f"{code} doesn't meet the requirement")
         return
-    sl.ohlc_save_to_db(data, code)
+    try:
+        sl.ohlc_upsert(data, code)
+        logging.info(f"Data saved to {code} table successfully.")
+    except Exception as e:  # One failed symbol (bad data, locked database) must not abort the whole pool
+        logging.error(f"Error saving {code} to database: {str(e)}")
     return
 
 df = sl.read_csv('symbol_list.csv')
@@ -0,0 +1,215 @@
+import re
+import numpy as np
+import pandas as pd
+
+##################################################################################
+# This module computes rolling features for a whole (date x ticker) panel at once.
+# Window statistics come from cumulative sums, so every step costs O(1) whatever the window length.
+# Features are registered by name and requested as '<name>_<window>', e.g. 'sharpe_ratio_180' or 'zscore_245'.
+##################################################################################
+
+FEATURES = {}  # Registered feature functions: name -> func(panel, window, **params) returning a (dates x tickers) array
+
+
+# This decorator registers a feature function under a name.
+def register_feature(name):
+    def wrap(func):
+        FEATURES[name] = func
+        return func
+    return wrap
+
+
+# This function splits a feature name like 'sharpe_ratio_180' into the registered name and the window.
+def parse(name):
+    match = re.fullmatch(r'(.+)_(\d+)', name)
+    if match is None or match.group(1) not in FEATURES:
+        raise KeyError(f"Unknown feature {name}. Registered features: {sorted(FEATURES)}")
+    return match.group(1), int(match.group(2))
+
+
+# This function computes a feature by its full name over the panel.
+def compute(panel, name, **params):
+    base, window = parse(name)
+    return FEATURES[base](panel, window, **params)
+
+
+# This function returns the sums of every `window` consecutive rows of values (for rows window-1 onwards).
+# Rows are split into blocks of `window`, and each window is the sum of a suffix of one block and a prefix of the next. Unlike a
+# difference of running totals, the rounding error of each sum then only depends on the values in its own window, so a constant
+# window after a volatile stretch still gives an exact zero variance.
+def window_sums(values, window):
+    n = len(values)
+    tail = values.shape[1:]
+    padded = np.concatenate([values, np.zeros((-n % window,) + tail)]).reshape((-1, window) + tail)
+    prefix = np.cumsum(padded, axis=1).reshape((-1,) + tail)[:n]
+    suffix = np.cumsum(padded[:, ::-1], axis=1)[:, ::-1].reshape((-1,) + tail)[:n]
+    last = np.arange(window - 1, n)
+    aligned = ((last + 1) % window == 0).reshape((-1,) + (1,) * len(tail))  # The window is exactly one block
+    return prefix[last] + np.where(aligned, 0, suffix[last - window + 1])
+
+
+# This function returns windowed sums of x, y and x*y along the date axis (for rows window-1 onwards) and the count of valid pairs per window.
+# Columns are centred on their mean first, which keeps sum-of-squares variances accurate for price levels; the centre of x is returned too.
+def rolling_sums(x, window, y=None):
+    y = x if y is None else y
+    valid = ~np.isnan(x) & ~np.isnan(y)
+    count = np.maximum(valid.sum(axis=0), 1)
+    x_centre = np.where(valid, x, 0).sum(axis=0) / count
+    y_centre = np.where(valid, y, 0).sum(axis=0) / count
+    x0 = np.where(valid, x - x_centre, 0)
+    y0 = np.where(valid, y - y_centre, 0)
+    return (window_sums(x0, window), window_sums(y0, window), window_sums(x0 * y0, window), window_sums(valid.astype(float), window),
+            x_centre)
+
+
+# This function returns the rolling mean, like DataFrame.rolling(window).mean(): NaN unless the whole window is valid.
+def rolling_mean(x, window):
+    out = np.full(x.shape, np.nan)
+    if len(x) < window:
+        return out
+    sx, _, _, count, centre = rolling_sums(x, window)
+    out[window - 1:] = np.where(count == window, sx / window + centre, np.nan)
+    return out
+
+
+# This function returns the rolling covariance of x and y (sample, ddof=1). With y=None it is the rolling variance of x.
+def rolling_cov(x, window, y=None):
+    out = np.full(x.shape, np.nan)
+    if len(x) < window:
+        return out
+    sx, sy, sxy, count, _ = rolling_sums(x, window, y)
+    cov = (sxy - sx * sy / window) / (window - 1)
+    if y is None:
+        # Rounding can leave a residue (or a negative number) for constant windows, tiny against the window's mean square
+        cov = np.where(cov <= 1e-12 * sxy / window, 0, cov)
+    out[window - 1:] = np.where(count == window, cov, np.nan)
+    return out
+
+
+def rolling_std(x, window):
+    return np.sqrt(rolling_cov(x, window))
+
+
+# This function regresses every column of y on x (a column, or an array like y) over rolling windows of several lengths at once.
+# It returns {window: (alpha, beta)}, the intercept and slope of each window's OLS fit, from window_sums of the centred values.
+# As in rolling_cov, values are NaN unless the whole window is valid, and beta is NaN when x does not vary over the window.
+def rolling_regression(y, x, windows):
+    y = np.asarray(y, dtype=float)
+    x = np.broadcast_to(np.asarray(x, dtype=float), y.shape)
+    valid = ~np.isnan(x) & ~np.isnan(y)
+    count = np.maximum(valid.sum(axis=0), 1)
+    x_centre = np.where(valid, x, 0).sum(axis=0) / count
+    y_centre = np.where(valid, y, 0).sum(axis=0) / count
+    x0 = np.where(valid, x - x_centre, 0)
+    y0 = np.where(valid, y - y_centre, 0)
+    products = (x0, y0, x0 * y0, x0 * x0, valid.astype(float))
+
+    out = {}
+    for window in windows:
+        alpha = np.full(y.shape, np.nan)
+        beta = np.full(y.shape, np.nan)
+        if len(y) >= window:
+            sx, sy, sxy, sxx, n = (window_sums(values, window) for values in products)
+            var = sxx - sx * sx / window
+            with np.errstate(divide='ignore', invalid='ignore'):
+                b = np.where(var > 1e-12 * sxx, (sxy - sx * sy / window) / var, np.nan)
+            a = (sy / window + y_centre) - b * (sx / window + x_centre)
+            full = n == window
+            beta[window - 1:] = np.where(full, b, np.nan)
+            alpha[window - 1:] = np.where(full, a, np.nan)
+        out[window] = (alpha, beta)
+    return out
+
+
+# This function applies a column-wise rolling calculation to each ticker's own rows, skipping dates where the ticker is absent,
+# which is what rolling over dict_ticker[ticker] gives. Present rows are moved to the top of each column, computed on, and moved back.
+def per_ticker(panel, field, func):
+    x = np.asarray(panel.matrix(field), dtype=float)
+    present = np.asarray(panel.present)
+    if present.all():
+        return func(x)
+    order = np.argsort(~present, axis=0, kind='stable')
+    result = func(np.take_along_axis(x, order, axis=0))
+    out = np.empty_like(result)
+    np.put_along_axis(out, order, result, axis=0)
+    out[~present] = np.nan
+    return out
+
+
+# This function returns the benchmark as a column aligned to the panel dates. It is either a ticker in the panel or a Series indexed by date.
+def benchmark_column(panel, field, benchmark):
+    if benchmark is None:
+        raise ValueError("This feature needs a benchmark: a ticker in the universe or a Series indexed by date")
+    if isinstance(benchmark, str):
+        if benchmark not in panel.ticker_index:
+            raise ValueError(f"Benchmark {benchmark!r} is not a ticker in the universe")
+        return panel.matrix(field, tickers=[benchmark])
+    return pd.Series(benchmark).reindex(panel.dates).to_numpy(dtype=float)[:, None]
+
+
+@register_feature('rolling_mean')
+def rolling_mean_feature(panel, window, field='close'):
+    return per_ticker(panel, field, lambda x: rolling_mean(x, window))
+
+
+@register_feature('rolling_std')
+def rolling_std_feature(panel, window, field='close'):
+    return per_ticker(panel, field, lambda x: rolling_std(x, window))
+
+
+# Rolling Sharpe ratio of daily returns (mean / std, not annualized), NaN when the window has no variation.
+@register_feature('sharpe_ratio')
+def sharpe_ratio_feature(panel, window, field='return'):
+    def sharpe(x):
+        std = rolling_std(x, window)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(std > 0, rolling_mean(x, window) / std, np.nan)
+    return per_ticker(panel, field, sharpe)
+
+
+# Rolling z-score of the value against its own window, as in clean.normalize (which uses a 245-day window).
+@register_feature('zscore')
+def zscore_feature(panel, window, field='close'):
+    def zscore(x):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (x - rolling_mean(x, window)) / rolling_std(x, window)
+    return per_ticker(panel, field, zscore)
+
+
+# Rolling beta of each ticker's returns against a benchmark, on the common date grid.
+@register_feature('beta')
+def beta_feature(panel, window, field='return', benchmark=None):
+    x = np.asarray(panel.matrix(field), dtype=float)
+    b = np.broadcast_to(benchmark_column(panel, field, benchmark), x.shape)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return rolling_cov(x, window, b) / rolling_cov(b, window)
+
+
+# Rolling CAPM alpha (daily intercept of the regression on the benchmark) of each ticker's returns, on the common date grid.
+@register_feature('alpha')
+def alpha_feature(panel, window, field='return', benchmark=None):
+    x = np.asarray(panel.matrix(field), dtype=float)
+    return rolling_regression(x, benchmark_column(panel, field, benchmark), [window])[window][0]
+
+
+# Rolling correlation of each ticker's returns with a benchmark, on the common date grid.
+@register_feature('correlation')
+def correlation_feature(panel, window, field='return', benchmark=None):
+    x = np.asarray(panel.matrix(field), dtype=float)
+    b = np.broadcast_to(benchmark_column(panel, field, benchmark), x.shape)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return rolling_cov(x, window, b) / (rolling_std(x, window) * rolling_std(b, window))
+
+
+if __name__ == '__main__':
+    # Constant stretches after a volatile one: the variance must be exactly 0 there, so zscore is NaN as with pandas
+    rng = np.random.default_rng(0)
+    for level in (57.3, 1e6):
+        x = np.r_[level * np.exp(np.cumsum(rng.normal(0, 0.02, 3000))), np.full(300, level)][:, None]
+        series = pd.Series(x[:, 0])
+        flat = (series.rolling(60).var() == 0).to_numpy()
+        zscore = ((x - rolling_mean(x, 60)) / rolling_std(x, 60))[:, 0]
+        expected = series.rolling(60).var().to_numpy()
+        error = np.nanmax(np.abs(rolling_cov(x, 60)[:, 0] - expected)[~flat] / expected[~flat])
+        print(f'level {level}: {np.count_nonzero(rolling_cov(x, 60)[flat])} of {flat.sum()} constant windows with a nonzero variance, '
+              f'{np.isfinite(zscore[flat]).sum()} finite zscores, relative error {error:.1e} elsewhere')
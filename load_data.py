@@ -1,7 +1,12 @@
 import mysql.connector
+import concurrent.futures
+import itertools
+import logging
+import os
 import pandas as pd
 import sl
 import clean
+from panel import split_frame
 
 ##################################################################################
 # This module if for data retrieving and preparing. 
@@ -9,34 +14,62 @@ import clean
 ##################################################################################
 
 
-def load_all(n = None): # Concat all ohlc data of each stock into one file
-    engine = sl.get_engine()
+def clean_one(code, start = None, end = None): # Retrieve and clean one stock in a worker process; None if it is missing or disqualified
+    data = sl.ohlc_read([code], start, end)
+    if len(data) == 0:
+        logging.info(f'{code} not found in the OHLC store')
+        return None
+    return clean.process(data)
 
+
+def clean_all(symbol_list, start = None, end = None, max_workers = None): # Yield (code, cleaned data) of each qualified stock as soon as it is ready
+    max_workers = max_workers or os.cpu_count()
+
+    # Stocks are retrieved and cleaned in a process pool. At most two per worker are in flight at any time,
+    # so memory depends on the number of workers and not on the number of stocks.
+    pending = iter(symbol_list)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(clean_one, code, start, end): code for code in itertools.islice(pending, 2 * max_workers)}
+        while futures:
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                code = futures.pop(future)
+                data = future.result()
+                if data is not None:
+                    yield code, data
+                for code in itertools.islice(pending, 1):
+                    futures[executor.submit(clean_one, code, start, end)] = code
+
+
+def load_all(n = None, start = None, end = None, output = None, max_workers = None, partition = 'year'): # Concat all ohlc data of each stock into one frame, or a Parquet dataset
     df = sl.read_csv('symbol_list_correct.csv')
     symbol_list = [symbol[0] for symbol in df.values.tolist()][0:n]
-    dataframes = [sl.mpretrieve(code, engine) for code in symbol_list]
-    dataframes_normalized = [clean.process(df) for df in dataframes]
 
-    dataframes_normalized = [df for df in dataframes_normalized if df is not None]
+    if output is not None: # Each stock is streamed to the Parquet dataset (see sl.save_parquet) as soon as it is ready
+        sl.save_parquet((data for _, data in clean_all(symbol_list, start, end, max_workers)), output, partition=partition)
+        return output
 
-    combined_df = pd.concat(dataframes_normalized, ignore_index=True)
-    engine.dispose()
+    dataframes_normalized = dict(clean_all(symbol_list, start, end, max_workers))
+    combined_df = pd.concat([dataframes_normalized[code] for code in symbol_list if code in dataframes_normalized], ignore_index=True)
 
     return combined_df
+
+
+def read_all(path, tickers = None, start = None, end = None, columns = None): # Read cleaned data written by load_all(output=path), only the given tickers, dates and columns
+    return sl.read_parquet(path, columns=columns, tickers=tickers, start=start, end=end)
     
 
 def dict_date(df): # This function creates a dictionary where the keys are unique dates from the dataframe, and the values are dataframes filtered by those dates.
-    d = {date: df[df['Date'] == date] for date in df['Date'].unique()}
+    d = split_frame(df, 'Date')
     return d
 def dict_ticker(df): # This function creates a dictionary where the keys are unique tickers from the dataframe, and the values are dataframes filtered by those tickers.
-    return {ticker: df[df['Ticker'] == ticker] for ticker in df['Ticker'].unique()}
+    return split_frame(df, 'Ticker')
 
 
 if __name__ == '__main__':
-    df = load_all()
-    sl.save_to_csv(df, 'all_normalized.csv')
-    
-    df = sl.read_csv('all_normalized.csv')
+    load_all(output='all_normalized')
+
+    df = read_all('all_normalized')
     d_date = dict_date(df)
     sl.save_dict(d_date, 'd_date.pkl')
     d_ticker = dict_ticker(df)
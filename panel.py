@@ -0,0 +1,266 @@
+import json
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from collections import OrderedDict
+from collections.abc import Mapping
+
+
+# This function numbers the distinct values of a column in one pass. It returns (keys, codes): the distinct values in order of
+# first appearance (or sorted), and for each row the position of its value in keys, -1 for missing values.
+def group_codes(values, sort=False):
+    codes, keys = pd.factorize(values, sort=sort)
+    return keys, codes
+
+
+# This function groups the rows of a column without scanning the data once per key. It returns (keys, order, offsets):
+# order lists the row positions sorted by key, keeping the original row order within a key, and the rows of keys[k]
+# are order[offsets[k]:offsets[k + 1]]. Rows with a missing value belong to no key.
+def group_index(values, sort=False):
+    keys, codes = group_codes(values, sort)
+    order = np.argsort(codes, kind='stable')
+    order = order[np.count_nonzero(codes < 0):]
+    offsets = np.zeros(len(keys) + 1, dtype=np.intp)
+    np.cumsum(np.bincount(codes[codes >= 0], minlength=len(keys)), out=offsets[1:])
+    return keys, order, offsets
+
+
+# This function splits a dataframe into {value: rows with that value in column}, e.g. {date: rows of that date}.
+# The frames equal df[df[column] == value], in the order of df[column].unique(), but are built with a single sort.
+def split_frame(df, column, sort=False):
+    keys, order, offsets = group_index(df[column], sort)
+    return {key: df.iloc[order[offsets[k]:offsets[k + 1]]] for k, key in enumerate(keys)}
+
+
+# This class stores universe data column by column: every field is one contiguous (date x ticker) array.
+# Dates and tickers are mapped to integer positions, and a presence mask records which (date, ticker) rows exist in the source data.
+class Panel:
+    def __init__(self, dates=(), tickers=(), fields=None, present=None):
+        self.dates = list(dates)
+        self.tickers = list(tickers)
+        self.date_index = {date: i for i, date in enumerate(self.dates)}
+        self.ticker_index = {ticker: j for j, ticker in enumerate(self.tickers)}
+        self.fields = dict(fields or {})
+        self.present = present if present is not None else np.ones(self.shape, dtype=bool)
+        self.by_date = PanelView(self, axis=0)  # Behaves like {date: DataFrame indexed by Ticker}
+        self.by_ticker = PanelView(self, axis=1)  # Behaves like {ticker: DataFrame indexed by Date}
+
+    @property
+    def shape(self):
+        return (len(self.dates), len(self.tickers))
+
+    @property
+    def columns(self):
+        return list(self.fields.keys())
+
+    @property
+    def nbytes(self):
+        return self.present.nbytes + sum(array.nbytes for array in self.fields.values())
+
+    # This method builds a panel from a long dataframe with 'Date' and 'Ticker' as columns or index levels, in one pass over the rows.
+    @classmethod
+    def from_frame(cls, df):
+        if 'Date' not in df.columns or 'Ticker' not in df.columns:
+            df = df.reset_index()
+        dates, date_codes = group_codes(df['Date'], sort=True)
+        tickers, ticker_codes = group_codes(df['Ticker'])
+        shape = (len(dates), len(tickers))
+
+        present = np.zeros(shape, dtype=bool)
+        present[date_codes, ticker_codes] = True
+        fields = {}
+        for column in df.columns:
+            if column in ('Date', 'Ticker'):
+                continue
+            values = df[column].to_numpy()
+            if values.dtype.kind in 'biuf':
+                array = np.full(shape, np.nan)
+            else:
+                array = np.full(shape, None, dtype=object)
+            array[date_codes, ticker_codes] = values
+            fields[column] = array
+        return cls(list(dates), list(tickers), fields, present)
+
+    # This method appends the rows of a long dataframe whose dates all come after the last stored date. Unknown tickers become new columns.
+    # It returns the position of the first appended date.
+    def append(self, df):
+        if 'Date' not in df.columns or 'Ticker' not in df.columns:
+            df = df.reset_index()
+        new_dates, date_codes = group_codes(df['Date'], sort=True)
+        if len(new_dates) == 0:
+            return len(self.dates)
+        if self.dates and new_dates[0] <= self.dates[-1]:
+            raise ValueError(f"Appended dates must come after {self.dates[-1]}, got {new_dates[0]}")
+        first = len(self.dates)
+        self.dates = self.dates + list(new_dates)
+        self.tickers = self.tickers + [ticker for ticker in pd.unique(df['Ticker']) if ticker not in self.ticker_index]
+        self.date_index = {date: i for i, date in enumerate(self.dates)}
+        self.ticker_index = {ticker: j for j, ticker in enumerate(self.tickers)}
+        rows = first + date_codes
+        cols = np.fromiter((self.ticker_index[ticker] for ticker in df['Ticker']), dtype=np.intp, count=len(df))
+
+        old_shape = self.present.shape
+        present = np.zeros(self.shape, dtype=bool)
+        present[:old_shape[0], :old_shape[1]] = self.present
+        present[rows, cols] = True
+        self.present = present
+        for name in self.columns + [column for column in df.columns if column not in self.fields and column not in ('Date', 'Ticker')]:
+            old = self.fields.get(name)
+            values = df[name].to_numpy() if name in df.columns else None
+            numeric = (old.dtype.kind if old is not None else values.dtype.kind) in 'biuf'
+            array = np.full(self.shape, np.nan) if numeric else np.full(self.shape, None, dtype=object)
+            if old is not None:
+                array[:old_shape[0], :old_shape[1]] = old
+            if values is not None:
+                array[rows, cols] = values
+            self.fields[name] = array
+        self.by_date.clear()
+        self.by_ticker.clear()
+        return first
+
+    # This method returns the long dataframe (indexed by Date and Ticker) of all rows present in the panel.
+    def to_frame(self):
+        date_pos, ticker_pos = np.nonzero(self.present)
+        index = pd.MultiIndex.from_arrays([np.asarray(self.dates, dtype=object)[date_pos], np.asarray(self.tickers, dtype=object)[ticker_pos]], names=['Date', 'Ticker'])
+        return pd.DataFrame({name: array[date_pos, ticker_pos] for name, array in self.fields.items()}, index=index)
+
+    # This method returns a field as a (dates x tickers) array. Dates or tickers outside the panel come back as NaN.
+    def matrix(self, field, dates=None, tickers=None):
+        array = self.fields.get(field)
+        if array is None:
+            array = np.full(self.shape, np.nan)
+        if dates is None and tickers is None:
+            return array
+        rows = self.positions(self.date_index, self.dates if dates is None else dates)
+        cols = self.positions(self.ticker_index, self.tickers if tickers is None else tickers)
+        out = array[np.ix_(np.maximum(rows, 0), np.maximum(cols, 0))].astype(float)
+        out[rows < 0, :] = np.nan
+        out[:, cols < 0] = np.nan
+        return out
+
+    # This method returns the presence mask for the given dates and tickers: True where the (date, ticker) row exists.
+    def presence(self, dates=None, tickers=None):
+        rows = self.positions(self.date_index, self.dates if dates is None else dates)
+        cols = self.positions(self.ticker_index, self.tickers if tickers is None else tickers)
+        out = np.asarray(self.present)[np.ix_(np.maximum(rows, 0), np.maximum(cols, 0))]
+        out[rows < 0, :] = False
+        out[:, cols < 0] = False
+        return out
+
+    # This method returns a field as a wide DataFrame with dates as the index and tickers as the columns.
+    def frame(self, field):
+        return pd.DataFrame(self.matrix(field), index=pd.Index(self.dates, name='Date'), columns=pd.Index(self.tickers, name='Ticker'))
+
+    # This method adds or replaces a field. Values are either a (dates x tickers) array or a wide DataFrame, which is aligned to the panel axes.
+    def set_field(self, name, values):
+        if isinstance(values, pd.DataFrame):
+            values = values.reindex(index=self.dates, columns=self.tickers).to_numpy(dtype=float)
+        values = np.asarray(values)
+        if values.shape != self.shape:
+            raise ValueError(f"Field {name} has shape {values.shape}, expected {self.shape}")
+        self.fields[name] = values
+        self.by_date.clear()
+        self.by_ticker.clear()
+        return
+
+    # This method writes the panel to a directory: one .npy file per field, the presence mask, and meta.json holding dates, tickers and column names.
+    # Extra metadata (e.g. the universe's start and end) is stored in meta.json as well.
+    def save(self, path, meta=None):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        columns = []
+        for k, (name, array) in enumerate(self.fields.items()):
+            if array.dtype.kind not in 'biuf':
+                raise TypeError(f"Field {name} is not numeric and cannot be saved as a binary array")
+            file = f'field_{k}.npy'
+            np.save(path / file, np.ascontiguousarray(array))
+            columns.append({'name': name, 'file': file, 'dtype': array.dtype.str})
+        np.save(path / 'present.npy', np.ascontiguousarray(self.present))
+        metadata = {'format': 'panel', 'version': 1, 'dates': self.dates, 'tickers': self.tickers, 'columns': columns}
+        metadata.update(meta or {})
+        with open(path / 'meta.json', 'w') as file:
+            json.dump(metadata, file, default=str)
+        return
+
+    # This method opens a panel written by `save`. With mmap_mode='r' the arrays are memory-mapped read-only:
+    # opening is near-instant, only the slices that are touched get paged in, and processes opening the same directory share the pages.
+    # It returns the panel and the full metadata dictionary.
+    @classmethod
+    def open(cls, path, mmap_mode='r'):
+        path = Path(path)
+        with open(path / 'meta.json') as file:
+            metadata = json.load(file)
+        fields = {column['name']: np.load(path / column['file'], mmap_mode=mmap_mode) for column in metadata['columns']}
+        present = np.load(path / 'present.npy', mmap_mode=mmap_mode)
+        return cls(metadata['dates'], metadata['tickers'], fields, present), metadata
+
+    @staticmethod
+    def positions(index, labels):
+        return np.fromiter((index.get(label, -1) for label in labels), dtype=np.intp, count=len(labels))
+
+
+# This class is a read-only dictionary view over one axis of a Panel. Each lookup slices the field arrays into a small DataFrame.
+# Recently used frames are kept in a bounded cache, so hot loops (e.g. BacktestModule.rebalance) do not rebuild them.
+# The frames are copies: write new columns through Universe.set_field rather than into dict_ticker[ticker].
+class PanelView(Mapping):
+    def __init__(self, panel, axis, cache_size=1024):
+        self.panel = panel
+        self.axis = axis
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['cache'] = OrderedDict()
+        return state
+
+    def clear(self):
+        self.cache.clear()
+
+    def labels(self):
+        return self.panel.dates if self.axis == 0 else self.panel.tickers
+
+    def index(self):
+        return self.panel.date_index if self.axis == 0 else self.panel.ticker_index
+
+    def __contains__(self, key):
+        i = self.index().get(key)
+        if i is None:
+            return False
+        return bool(self.panel.present[i].any() if self.axis == 0 else self.panel.present[:, i].any())
+
+    def __iter__(self):
+        has_rows = self.panel.present.any(axis=1 - self.axis)
+        return (label for label, keep in zip(self.labels(), has_rows) if keep)
+
+    def __len__(self):
+        return int(self.panel.present.any(axis=1 - self.axis).sum())
+
+    def __getitem__(self, key):
+        frame = self.cache.get(key)
+        if frame is not None:
+            self.cache.move_to_end(key)
+            return frame
+        if key not in self:
+            raise KeyError(key)
+        frame = self.build(self.index()[key], key)
+        self.cache[key] = frame
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return frame
+
+    # This method slices one row (axis 0) or one column (axis 1) of every field, keeping only present rows.
+    # The layout matches the frames Universe.coordinate used to build: dict_date frames carry a 'Date' column and are indexed by Ticker, and vice versa.
+    def build(self, i, key):
+        panel = self.panel
+        if self.axis == 0:
+            keep = np.flatnonzero(panel.present[i])
+            index = pd.Index(np.asarray(panel.tickers, dtype=object)[keep], name='Ticker')
+            data = {'Date': key}
+            data.update({name: array[i, keep] for name, array in panel.fields.items()})
+        else:
+            keep = np.flatnonzero(panel.present[:, i])
+            index = pd.Index(np.asarray(panel.dates, dtype=object)[keep], name='Date')
+            data = {'Ticker': key}
+            data.update({name: array[keep, i] for name, array in panel.fields.items()})
+        return pd.DataFrame(data, index=index)
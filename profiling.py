@@ -0,0 +1,102 @@
+import cProfile
+import gc
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+import numpy as np
+
+##################################################################################
+# This module instruments the hot path of a backtest. BacktestModule(profile=True) wraps its phases in a Profiler,
+# which accumulates wall time and call counts per phase, the latency of every simulated day, and allocation counters.
+# With profiling off the module uses NullProfiler, whose hooks return one shared no-op context, so nothing is measured.
+##################################################################################
+
+PERCENTILES = (50, 90, 99)
+_NULL = nullcontext()
+
+
+class NullProfiler:
+    enabled = False
+
+    def phase(self, name):
+        return _NULL
+
+    def day(self):
+        return _NULL
+
+    def run(self):
+        return _NULL
+
+    def report(self):
+        return None
+
+
+# This class records where the time of a run goes. Use phase(name) around a part of the work, day() around one simulated day,
+# and run() around the whole run; report() returns the results as a dictionary.
+# With dump set to a file path, the run is also recorded by cProfile and its stats written there (read them with pstats or snakeviz).
+class Profiler:
+    enabled = True
+
+    def __init__(self, dump=None):
+        self.dump = dump
+        self.phases = {}  # name -> [seconds, calls]
+        self.day_seconds = []
+        self.total_seconds = 0.0
+        self.allocated_blocks = 0  # Net change in allocated memory blocks over the run
+        self.gc_collections = 0  # Garbage collections triggered by allocations during the run
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            entry = self.phases.setdefault(name, [0.0, 0])
+            entry[0] += time.perf_counter() - start
+            entry[1] += 1
+
+    @contextmanager
+    def day(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.day_seconds.append(time.perf_counter() - start)
+
+    @contextmanager
+    def run(self):
+        profile = cProfile.Profile() if self.dump is not None else None
+        blocks = sys.getallocatedblocks()
+        collections = sum(stat['collections'] for stat in gc.get_stats())
+        start = time.perf_counter()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                profile.dump_stats(self.dump)
+            self.total_seconds += time.perf_counter() - start
+            self.allocated_blocks += sys.getallocatedblocks() - blocks
+            self.gc_collections += sum(stat['collections'] for stat in gc.get_stats()) - collections
+
+    # This method returns {'total_seconds', 'phases': {name: {'seconds', 'calls', 'mean_seconds', 'share'}}, 'days': {...},
+    # 'allocated_blocks', 'gc_collections', 'dump'}. share is the fraction of the total run time spent in the phase.
+    def report(self):
+        phases = {name: {'seconds': seconds,
+                         'calls': calls,
+                         'mean_seconds': seconds / calls if calls else 0.0,
+                         'share': seconds / self.total_seconds if self.total_seconds else 0.0}
+                  for name, (seconds, calls) in sorted(self.phases.items(), key=lambda item: -item[1][0])}
+        days = {'count': len(self.day_seconds)}
+        if self.day_seconds:
+            latency = np.asarray(self.day_seconds)
+            days.update({f'p{q}_seconds': float(np.percentile(latency, q)) for q in PERCENTILES})
+            days.update({'mean_seconds': float(latency.mean()), 'max_seconds': float(latency.max())})
+        return {'total_seconds': self.total_seconds,
+                'phases': phases,
+                'days': days,
+                'allocated_blocks': self.allocated_blocks,
+                'gc_collections': self.gc_collections,
+                'dump': self.dump}
@@ -0,0 +1,95 @@
+import concurrent.futures
+import numpy as np
+import pandas as pd
+import analytics
+from BT import BacktestModule
+
+##################################################################################
+# This module tests how robust the result of a finished backtest is by resampling its daily returns into thousands of other paths:
+#   - 'block': circular block bootstrap, paths glued together from blocks of consecutive days, which keeps short-term autocorrelation
+#     and volatility clustering;
+#   - 'entry': the same strategy entered on a random date and held for `horizon` days, paying entry_cost on the gross exposure bought.
+# Sharpe, CAGR and max drawdown of every path are computed as whole-array operations on a (paths x days) batch, with the
+# definitions of analytics.summary, and batches run in parallel in a process pool.
+##################################################################################
+
+STATISTICS = ('sharpe', 'cagr', 'max_drawdown')
+
+
+# This function returns (paths x horizon) indices into n returns for the circular block bootstrap: random blocks of `block` consecutive days.
+def block_indices(rng, n, n_paths, horizon, block):
+    starts = rng.integers(0, n, size=(n_paths, -(-horizon // block)))
+    return ((starts[:, :, None] + np.arange(block)) % n).reshape(n_paths, -1)[:, :horizon]
+
+
+# This function returns (paths x horizon) indices of `horizon` consecutive returns starting on a random day, and the entry days.
+def entry_indices(rng, n, n_paths, horizon):
+    starts = rng.integers(0, n - horizon + 1, size=n_paths)
+    return starts[:, None] + np.arange(horizon), starts
+
+
+# This function returns the sharpe, cagr and max_drawdown of every path of a (paths x days) array of returns as a (paths x 3) array.
+# Each path starts from a value of 1, as the first point of its curve, like an equity curve in analytics.summary.
+def path_statistics(returns, risk_free=0.02, periods=analytics.PERIODS_PER_YEAR):
+    excess = returns - ((1 + risk_free)**(1 / periods) - 1)
+    curve = np.cumprod(1 + returns, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sharpe = excess.mean(axis=1) / returns.std(axis=1) * np.sqrt(periods)
+        cagr = curve[:, -1]**(periods / (returns.shape[1] + 1)) - 1
+        drawdown = 1 - curve / np.maximum(np.maximum.accumulate(curve, axis=1), 1)
+    return np.column_stack([sharpe, cagr, np.maximum(drawdown.max(axis=1), 0)])
+
+
+# This function resamples one batch of paths; it runs in a worker process.
+def resample_batch(returns, gross, method, n_paths, horizon, block, entry_cost, seed, risk_free, periods):
+    rng = np.random.default_rng(seed)
+    if method == 'block':
+        paths = returns[block_indices(rng, len(returns), n_paths, horizon, block)]
+    else:
+        index, starts = entry_indices(rng, len(returns), n_paths, horizon)
+        paths = returns[index]
+        paths[:, 0] = (1 + paths[:, 0]) * (1 - entry_cost * gross[starts]) - 1
+    return path_statistics(paths, risk_free, periods)
+
+
+# This function resamples the daily returns of a backtest and returns (paths, intervals):
+# paths is a DataFrame of the sharpe, cagr and max_drawdown of every resampled path, and intervals a DataFrame with, for each
+# statistic, the value of the original backtest, the median, and the lower and upper bounds of the `confidence` interval.
+# source is a finished BacktestModule or an equity curve (then pass weights, its (dates x tickers) weight history, for entry_cost).
+# horizon is the length of the paths in days: the whole backtest for 'block', and half of it for 'entry' by default.
+# Paths are drawn in batches of batch_size with independent seeds derived from seed; max_workers=1 runs them in this process.
+def resample(source, n_paths=10_000, method='block', block=20, horizon=None, confidence=0.95, entry_cost=0.0, weights=None,
+             seed=None, risk_free=0.02, periods=analytics.PERIODS_PER_YEAR, batch_size=1000, max_workers=None):
+    if method not in ('block', 'entry'):
+        raise ValueError("Invalid method. Must be 'block' or 'entry'.")
+    if isinstance(source, BacktestModule):
+        weights = source.weight_history()
+        source = pd.Series(source.portfolio_value)
+    values = analytics.curve_frame(source).iloc[:, 0]
+    returns = analytics.returns(values).iloc[1:, 0].to_numpy()
+    gross = np.zeros(len(values)) if weights is None else np.abs(np.nan_to_num(np.asarray(weights, dtype=float))).sum(axis=1)
+    valid = ~np.isnan(returns)
+    returns = returns[valid]
+    gross = gross[:-1][valid]  # Exposure bought on the day before each return
+    horizon = horizon or (len(returns) if method == 'block' else len(returns) // 2)
+    if len(returns) == 0 or horizon > len(returns):
+        raise ValueError(f"{len(returns)} daily returns are not enough for paths of {horizon} days")
+
+    sizes = [min(batch_size, n_paths - first) for first in range(0, n_paths, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    args = [(returns, gross, method, size, horizon, block, entry_cost, s, risk_free, periods) for size, s in zip(sizes, seeds)]
+    if max_workers == 1 or len(args) == 1:
+        batches = [resample_batch(*arg) for arg in args]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            batches = list(executor.map(resample_batch, *zip(*args)))
+    paths = pd.DataFrame(np.vstack(batches), columns=list(STATISTICS))
+
+    observed = analytics.summary(values, risk_free=risk_free, periods=periods).iloc[0]
+    tail = (1 - confidence) / 2 * 100
+    intervals = pd.DataFrame({'observed': observed[list(STATISTICS)].to_numpy(dtype=float),
+                              'median': np.nanpercentile(paths, 50, axis=0),
+                              'lower': np.nanpercentile(paths, tail, axis=0),
+                              'upper': np.nanpercentile(paths, 100 - tail, axis=0)},
+                             index=list(STATISTICS))
+    return paths, intervals
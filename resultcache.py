@@ -0,0 +1,266 @@
+import functools
+import hashlib
+import importlib
+import inspect
+import os
+import pickle
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from panel import Panel
+from Universe import Universe
+
+##################################################################################
+# This module keeps the results of myStrategy.calculate and BacktestModule.run_backtest on disk, keyed by a hash of everything
+# they depend on: the universe data (dates, tickers and every field array), the strategy and backtest parameters, the source of
+# any custom callable, and the source of the modules that do the calculation. Rerunning a notebook with the same inputs loads
+# the stored result; any change gives a new key, so stale results are never returned.
+# Entries are pickle files in one directory, evicted least recently used first once the directory grows past max_bytes.
+# Enable it with myStrategy(..., cache=True) and BacktestModule(..., cache=True), or pass a ResultCache to choose the directory.
+##################################################################################
+
+CODE_MODULES = ('strategy', 'selection', 'sizing', 'schedule', 'features', 'riskmodel', 'BT')  # Their source is part of every key
+STRATEGY_RESULTS = ('position_dict', 'weights', 'selection_matrix', 'rebalance_dates')
+BACKTEST_RESULTS = ('portfolio_value', 'cash', 'holdings')
+
+_code_version = None
+_default_cache = None
+
+
+# This function feeds a value into a hash in a canonical form: arrays and frames by their bytes, universes and panels by their data
+# (see universe_fingerprint), containers item by item, callables by their source (see callable_fingerprint), objects without their
+# own repr by their attributes, and anything else by its repr.
+# `seen` holds the ids of the containers being hashed, so a reference back to one of them (a cycle) is hashed as a token.
+def _update(h, value, seen=None):
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        h.update(b'<cycle>')
+        return
+    if isinstance(value, (dict, list, tuple, set, frozenset)) or hasattr(value, '__dict__'):
+        seen.add(id(value))
+        try:
+            _update_value(h, value, seen)
+        finally:
+            seen.discard(id(value))
+    else:
+        _update_value(h, value, seen)
+
+
+def _update_value(h, value, seen):
+    if isinstance(value, np.ndarray):
+        h.update(f'array {value.dtype.str} {value.shape};'.encode())
+        if value.dtype.kind == 'O':
+            h.update(pd.util.hash_array(value.ravel()).tobytes())
+        else:
+            h.update(np.ascontiguousarray(value).reshape(-1).view(np.uint8).data)
+    elif isinstance(value, (pd.DataFrame, pd.Series)):
+        h.update(type(value).__name__.encode())
+        _update(h, value.to_numpy(), seen)
+        _update(h, list(value.index), seen)
+        _update(h, list(value.columns) if isinstance(value, pd.DataFrame) else value.name, seen)
+    elif isinstance(value, Universe):
+        h.update(f'Universe:{universe_fingerprint(value)};'.encode())
+    elif isinstance(value, Panel):
+        h.update(f'Panel:{panel_fingerprint(value)};'.encode())
+    elif isinstance(value, dict):
+        h.update(b'dict{')
+        for key in sorted(value, key=repr):
+            _update(h, key, seen)
+            _update(h, value[key], seen)
+        h.update(b'}')
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        h.update(f'{type(value).__name__}['.encode())
+        for item in (sorted(value, key=repr) if isinstance(value, (set, frozenset)) else value):
+            _update(h, item, seen)
+        h.update(b']')
+    elif callable(value) and not isinstance(value, type):
+        h.update(callable_fingerprint(value, seen).encode())
+    elif hasattr(value, '__dict__') and type(value).__repr__ is object.__repr__:
+        h.update(f'{type(value).__qualname__}('.encode())  # The default repr holds a memory address, so objects like a Schedule are hashed by their attributes
+        _update(h, vars(value), seen)
+        h.update(b')')
+    else:
+        h.update(f'{type(value).__name__}:{value!r};'.encode())
+
+
+# This function returns a hex digest of the given values.
+def digest(*values):
+    return _digest(values, set())
+
+
+def _digest(values, seen):
+    h = hashlib.blake2b(digest_size=16)
+    for value in values:
+        _update(h, value, seen)
+    return h.hexdigest()
+
+
+# This function fingerprints a function by its module, name and source (or bytecode when the source is not available),
+# its default arguments and the values it closes over. Bound methods are fingerprinted by their function.
+# seen is passed on by _update, so a function that closes over itself (or over a container holding it) does not recurse forever.
+def callable_fingerprint(func, seen=None):
+    seen = set() if seen is None else seen
+    if isinstance(func, functools.partial):
+        return _digest(('partial', func.func, func.args, func.keywords), seen)
+    func = getattr(func, '__func__', func)
+    code = getattr(func, '__code__', None)
+    if code is None:
+        return _digest((type(func).__qualname__, repr(func)), seen)
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        source = (code.co_code, repr(code.co_consts))
+    closure = [cell.cell_contents for cell in func.__closure__ or ()]
+    seen.add(id(func))
+    try:
+        return _digest((func.__module__, func.__qualname__, source, func.__defaults__, func.__kwdefaults__, closure), seen)
+    finally:
+        seen.discard(id(func))
+
+
+# This function returns a digest of the source of the modules in CODE_MODULES, so results are recomputed after the code changes.
+def code_version():
+    global _code_version
+    if _code_version is None:
+        _code_version = digest([inspect.getsource(importlib.import_module(name)) for name in CODE_MODULES])
+    return _code_version
+
+
+# This function fingerprints the data of a universe: its dates, tickers, presence mask and every field array.
+# The content of every array is hashed on each call, so arrays edited in place give a new fingerprint.
+def universe_fingerprint(universe):
+    return panel_fingerprint(universe.panel)
+
+
+def panel_fingerprint(panel):
+    return digest(panel.dates, panel.tickers, panel.present, panel.fields)
+
+
+# This function returns the cache key of a myStrategy: universe data, date range, selection and position functions, and parameters.
+def strategy_key(strategy):
+    model = strategy.risk_model
+    settings = None if model is None else (type(model).__qualname__, model.window, model.halflife, model.field, model.num_factors, model.refresh, model.min_periods)
+    return digest('strategy', code_version(), universe_fingerprint(strategy.UNI), strategy.dates, strategy.stock_select_func,
+                  strategy.position_func, strategy.stock_number, strategy.score, strategy.leverage_limit, strategy.risk_budget,
+                  None if strategy.schedule is None else vars(strategy.schedule), settings)
+
+
+# This function returns the cache key of a BacktestModule: its strategy's key, the positions it trades and the backtest parameters.
+# The positions are hashed too, since they can be edited or set after the strategy is calculated.
+# The engine is not part of it, since both engines give the same portfolio values.
+def backtest_key(backtest):
+    strategy = backtest.strategy
+    return digest('backtest', strategy_key(strategy), strategy.position_dict, strategy.rebalance_dates, backtest.tcost_model,
+                  backtest.start, backtest.end, backtest.holding_feerate, backtest.initial_cash)
+
+
+# This class stores results in `directory`, one pickle file per key, keeping the total size under max_bytes by removing the
+# least recently used entries. Reading an entry marks it as used.
+class ResultCache:
+    def __init__(self, directory='.result_cache', max_bytes=2**30):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key):
+        return self.directory / f'{key}.pkl'
+
+    # This method returns the value stored under key, or None.
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as file:
+                value = pickle.load(file)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        os.utime(path)
+        self.hits += 1
+        return value
+
+    # This method stores value under key, then evicts old entries if the cache is over its size limit.
+    def put(self, key, value):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.path(key)
+        temporary = path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(temporary, 'wb') as file:
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, path)  # Readers in other processes never see a partly written entry
+        self.evict()
+        return
+
+    # This method removes the least recently used entries until the cache fits in max_bytes.
+    def evict(self):
+        entries = []
+        for path in self.directory.glob('*.pkl'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+        return
+
+    def clear(self):
+        for path in self.directory.glob('*.pkl'):
+            path.unlink(missing_ok=True)
+        return
+
+    # This method sets the attributes of obj from the entry under key and returns True, or returns False if there is none.
+    def restore(self, key, obj):
+        value = self.get(key)
+        if value is None:
+            return False
+        for name, attribute in value.items():
+            setattr(obj, name, attribute)
+        return True
+
+    # This method stores the given attributes of obj under key.
+    def store(self, key, obj, attributes):
+        self.put(key, {name: getattr(obj, name) for name in attributes})
+        return
+
+
+# This function returns the ResultCache for a cache setting: None or False for no cache, True for a cache in .result_cache,
+# a directory path, or a ResultCache.
+def make_cache(cache):
+    global _default_cache
+    if cache is None or cache is False:
+        return None
+    if isinstance(cache, ResultCache):
+        return cache
+    if cache is True:
+        if _default_cache is None:
+            _default_cache = ResultCache()
+        return _default_cache
+    return ResultCache(cache)
+
+
+if __name__ == '__main__':
+    # A selection function that captures the universe, as a closure and as a partial: the universe is hashed by its data,
+    # so the key is stable, follows the data, and hashing does not recurse through the Universe -> Panel -> PanelView cycle
+    dates = ['2024-01-02', '2024-01-03', '2024-01-04']
+    frame = pd.DataFrame({'Date': np.repeat(dates, 2), 'Ticker': ['A', 'B'] * 3, 'close': [1.0, 2.0, 1.1, 2.1, 1.2, 2.2]})
+    U = Universe(['A', 'B'], start=dates[0], end=dates[-1])
+    U.panel = Panel.from_frame(frame)
+
+    def select(universe, n):
+        return {date: universe.panel.tickers[:n] for date in universe.panel.dates}
+
+    def make_closure(universe):
+        return lambda: select(universe, 1)
+
+    closure = make_closure(U)
+    partial = functools.partial(select, U, 1)
+    node = {'universe': U}
+    node['self'] = node
+    keys = [digest(closure), digest(partial), digest(node)]
+    print('stable', keys == [digest(closure), digest(partial), digest(node)])
+    U.panel.fields['close'][0, 0] = 9.0
+    print('follows the data', all(a != b for a, b in zip(keys, [digest(closure), digest(partial), digest(node)])))
@@ -0,0 +1,187 @@
+import math
+import weakref
+from collections import OrderedDict
+import numpy as np
+from panel import Panel
+
+##################################################################################
+# This module maintains the covariance of daily returns across all tickers of a panel, day by day.
+# Moving to the next date is a rank-one update of running sums (add the new day, drop the one leaving a rolling window, or decay
+# an EWMA), O(N^2) instead of a new O(window x N^2) estimate; the sums are rebuilt exactly every `window` days so rounding does not drift.
+# A PCA factor model is kept on top of it: a full eigendecomposition every `refresh` days, and between them one step of subspace
+# iteration from the previous factors, O(N^2 k) instead of O(N^3). Results are cached by date, and models are shared per
+# (panel, window, halflife, field) through shared(), so several strategies on one universe reuse the same work.
+##################################################################################
+
+
+# This class estimates the covariance of `field` (daily returns by default) over a rolling window of `window` days, or as an
+# exponentially weighted average with the given halflife in days. Tickers are in panel order. Missing returns count as zero, and
+# tickers with fewer than min_periods valid returns in the lookback window (default: half the window, or halflife for EWMA) have NaN
+# rows and columns.
+class RiskModel:
+    def __init__(self, panel, window=180, halflife=None, field='return', num_factors=10, refresh=20, min_periods=None, cache_size=64):
+        self.panel = panel
+        self.window = window
+        self.halflife = halflife
+        self.field = field
+        self.num_factors = num_factors
+        self.refresh = refresh
+        self.min_periods = min_periods or (math.ceil(halflife) if halflife else math.ceil(window / 2))
+        self.decay = 0.5**(1 / halflife) if halflife else None
+        self.lookback = math.ceil(20 * halflife) if halflife else window  # EWMA weights older than this are below 1e-6
+        self.cache_size = cache_size
+        self.cov_cache = OrderedDict()
+        self.factor_cache = OrderedDict()
+        self.returns = None
+        self.row = None  # Last row folded into the running sums
+        self.factors = None  # (row of last full decomposition, loadings) of the factor model
+        self.fresh = 0  # Rows folded in incrementally since the sums were rebuilt
+
+    # This method reads the returns from the panel, again if the panel has grown since (e.g. after Universe.update).
+    def load(self):
+        if self.returns is None or len(self.returns) != len(self.panel.dates):
+            values = np.asarray(self.panel.matrix(self.field), dtype=float)
+            self.valid = ~np.isnan(values)
+            self.returns = np.where(self.valid, values, 0)
+            self.cov_cache.clear()
+            self.factor_cache.clear()
+            self.row = None
+            self.factors = None
+        return
+
+    # This method rebuilds the running sums exactly from the rows of the lookback window that ends at `row`.
+    def rebuild(self, row):
+        first = max(0, row - self.lookback + 1)
+        x = self.returns[first:row + 1]
+        if self.decay is None:
+            self.sum_xx = x.T @ x
+            self.sum_x = x.sum(axis=0)
+            self.weight = float(len(x))
+        else:
+            w = self.decay**np.arange(len(x) - 1, -1, -1)
+            self.sum_xx = (x * w[:, None]).T @ x
+            self.sum_x = w @ x
+            self.weight = float(w.sum())
+        self.count = self.valid[first:row + 1].sum(axis=0)
+        self.row = row
+        self.fresh = 0
+        return
+
+    # This method folds rows row+1 .. `row` into the running sums with rank-one updates.
+    def advance(self, row):
+        for r in range(self.row + 1, row + 1):
+            x = self.returns[r]
+            if self.decay is None:
+                self.sum_xx += np.outer(x, x)
+                self.sum_x += x
+                if r >= self.window:
+                    old = self.returns[r - self.window]
+                    self.sum_xx -= np.outer(old, old)
+                    self.sum_x -= old
+                else:
+                    self.weight += 1
+            else:
+                self.sum_xx = self.decay * self.sum_xx + np.outer(x, x)
+                self.sum_x = self.decay * self.sum_x + x
+                self.weight = self.decay * self.weight + 1
+            # Valid returns are counted over the lookback window, as in rebuild
+            self.count += self.valid[r]
+            if r >= self.lookback:
+                self.count -= self.valid[r - self.lookback]
+        self.row = row
+        return
+
+    # This method brings the running sums to `row`: forward by rank-one updates, or by a rebuild when moving backwards,
+    # jumping further than the lookback window, or after a window's worth of incremental updates.
+    def move_to(self, row):
+        self.load()
+        steps = None if self.row is None else row - self.row
+        if steps is None or steps < 0 or self.fresh + steps >= self.lookback:
+            self.rebuild(row)
+        elif steps > 0:
+            self.advance(row)
+            self.fresh += steps
+        return
+
+    # This method returns the (tickers x tickers) covariance using the returns up to and including the date at panel row `row`.
+    def covariance_at(self, row):
+        cov = self.cov_cache.get(row)
+        if cov is not None:
+            self.cov_cache.move_to_end(row)
+            return cov
+        self.move_to(row)
+        mean = self.sum_x / self.weight
+        if self.decay is None:
+            cov = (self.sum_xx - np.outer(self.sum_x, mean)) / max(self.weight - 1, 1)
+        else:
+            cov = self.sum_xx / self.weight - np.outer(mean, mean)
+        thin = self.count < self.min_periods
+        cov[thin, :] = np.nan
+        cov[:, thin] = np.nan
+        cov.setflags(write=False)
+        self.cov_cache[row] = cov
+        if len(self.cov_cache) > self.cache_size:
+            self.cov_cache.popitem(last=False)
+        return cov
+
+    def covariance(self, date):
+        return self.covariance_at(self.panel.date_index[date])
+
+    # This method returns the PCA factor model at panel row `row` as (loadings, factor_variances, idiosyncratic_variances):
+    # loadings is (tickers x num_factors), so the covariance is approximately loadings @ diag(factor_variances) @ loadings.T + diag(idiosyncratic).
+    # Tickers with NaN covariance get zero loadings and NaN idiosyncratic variance.
+    def factor_model_at(self, row):
+        model = self.factor_cache.get(row)
+        if model is not None:
+            self.factor_cache.move_to_end(row)
+            return model
+        cov = self.covariance_at(row)
+        known = ~np.isnan(np.diag(cov))
+        sigma = np.where(np.isnan(cov), 0, cov)
+        k = min(self.num_factors, int(known.sum()))
+        if self.factors is None or abs(row - self.factors[0]) >= self.refresh or self.factors[1].shape[1] != k:
+            values, vectors = np.linalg.eigh(sigma)
+            loadings = vectors[:, ::-1][:, :k]
+            self.factors = (row, loadings)
+        else:
+            # One step of subspace iteration from the previous factors, then the exact eigenvectors within that subspace
+            q, _ = np.linalg.qr(sigma @ self.factors[1])
+            values, vectors = np.linalg.eigh(q.T @ sigma @ q)
+            loadings = q @ vectors[:, ::-1]
+            self.factors = (self.factors[0], loadings)
+        factor_variances = ((sigma @ loadings) * loadings).sum(axis=0)
+        idiosyncratic = np.where(known, np.maximum(np.diag(sigma) - (loadings**2 * factor_variances).sum(axis=1), 0), np.nan)
+        model = (loadings, factor_variances, idiosyncratic)
+        self.factor_cache[row] = model
+        if len(self.factor_cache) > self.cache_size:
+            self.factor_cache.popitem(last=False)
+        return model
+
+    def factor_model(self, date):
+        return self.factor_model_at(self.panel.date_index[date])
+
+    # This method returns the covariance implied by the factor model, e.g. as a better conditioned input to risk parity sizing.
+    def factor_covariance(self, date):
+        loadings, factor_variances, idiosyncratic = self.factor_model(date)
+        cov = (loadings * factor_variances) @ loadings.T + np.diag(np.nan_to_num(idiosyncratic))
+        thin = np.isnan(idiosyncratic)
+        cov[thin, :] = np.nan
+        cov[:, thin] = np.nan
+        return cov
+
+    # This method yields (date, covariance) for the given dates in order, updating incrementally between consecutive dates.
+    def iter_covariance(self, dates):
+        for row, date in zip(Panel.positions(self.panel.date_index, dates), dates):
+            yield date, (self.covariance_at(row) if row >= 0 else None)
+
+
+_shared = weakref.WeakKeyDictionary()  # panel -> {(window, halflife, field): RiskModel}
+
+
+# This function returns the risk model of a panel for the given settings, creating it on first use, so strategies share it.
+def shared(panel, window=180, halflife=None, field='return', **kwargs):
+    models = _shared.setdefault(panel, {})
+    key = (window, halflife, field)
+    if key not in models:
+        models[key] = RiskModel(panel, window=window, halflife=halflife, field=field, **kwargs)
+    return models[key]
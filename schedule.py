@@ -0,0 +1,114 @@
+import numpy as np
+import pandas as pd
+
+##################################################################################
+# This module decides on which dates a strategy trades. A Schedule combines calendar triggers (every N trading days, the first
+# trading day of each week, the last trading day of each month) with threshold triggers (held weights drifting away from the last
+# targets, or the trade to the current targets exceeding a turnover), and a no-trade band that leaves names near their target alone.
+# Selection and sizing run only on trade dates. In between, the held weights are marked forward from the daily returns in one
+# array pass per holding period. myStrategy(rebalance=...) applies a schedule and BacktestModule trades only on its rebalance dates.
+##################################################################################
+
+CALENDARS = ('daily', 'weekly', 'month_end')
+_MONDAY = pd.Timestamp('1970-01-05')
+
+
+# This function returns the weights held after each day of a holding period that starts with `weights` (fractions of equity,
+# the rest in cash) and earns the (days x tickers) `returns`. Missing returns leave a name's value unchanged.
+def mark(weights, returns):
+    value = weights * np.cumprod(1 + np.nan_to_num(returns), axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return value / (1 - np.sum(weights) + value.sum(axis=1, keepdims=True))
+
+
+# This function returns the weights held just before trading: `weights` (tickers,) or (days x tickers) after earning one day of
+# `returns` of the same shape, one day per row.
+def mark_day(weights, returns):
+    value = weights * (1 + np.nan_to_num(returns))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return value / (1 - np.sum(weights, axis=-1, keepdims=True) + value.sum(axis=-1, keepdims=True))
+
+
+# This class describes when a portfolio is rebalanced.
+# calendar is 'daily', 'weekly' (first trading day of each week), 'month_end' (last trading day of each month), an integer N
+# (every N trading days), or None (no calendar trades). The first date always trades.
+# drift triggers a trade when the held weights have moved away from the last targets by more than drift (sum of absolute differences).
+# turnover triggers a trade when reaching the current targets would trade more than turnover; it needs the targets of every date.
+# On a trade date, names whose held weight is within band of the target are not traded.
+class Schedule:
+    def __init__(self, calendar='daily', drift=None, turnover=None, band=0.0):
+        if not (calendar is None or calendar in CALENDARS or (isinstance(calendar, int) and calendar > 0)):
+            raise ValueError(f"Invalid calendar. Must be one of {CALENDARS}, a positive number of days, or None.")
+        self.calendar = calendar
+        self.drift = drift
+        self.turnover = turnover
+        self.band = band
+
+    # This method returns a boolean array marking the calendar trade dates among `dates`.
+    def calendar_days(self, dates):
+        days = np.zeros(len(dates), dtype=bool)
+        if len(dates) == 0:
+            return days
+        if self.calendar == 'daily':
+            days[:] = True
+        elif self.calendar == 'weekly':
+            week = ((pd.to_datetime(dates) - _MONDAY).days // 7).to_numpy()
+            days[1:] = week[1:] != week[:-1]
+        elif self.calendar == 'month_end':
+            month = pd.to_datetime(dates).to_period('M').to_numpy()
+            days[:-1] = month[:-1] != month[1:]
+        elif self.calendar is not None:
+            days[::self.calendar] = True
+        days[0] = True
+        return days
+
+    # This method returns (weights, trades): the (dates x tickers) weights held at the close of each date and a boolean array of trade dates.
+    # returns is the (dates x tickers) matrix of daily returns, and targets(rows) returns the (len(rows) x tickers) target weights of the
+    # given rows of dates. Targets are requested in one call for all calendar dates, and once more for each threshold trade.
+    def apply(self, dates, returns, targets):
+        n, m = returns.shape
+        weights = np.zeros((n, m))
+        trades = np.zeros(n, dtype=bool)
+        if n == 0:
+            return weights, trades
+        scheduled = np.flatnonzero(self.calendar_days(dates))
+        daily = targets(np.arange(n)) if self.turnover is not None else None
+        known = {} if daily is not None else dict(zip(scheduled.tolist(), targets(scheduled)))
+        calendar_rows = np.append(scheduled, n)
+        next_calendar = np.searchsorted(scheduled, np.arange(n), side='right')
+
+        current = np.zeros(m)  # Weights held before trading on `row`
+        row = 0
+        while row < n:
+            if daily is not None:
+                target = daily[row]
+            else:
+                target = known[row] if row in known else targets(np.array([row]))[0]
+            weights[row] = np.where(np.abs(target - current) <= self.band, current, target) if self.band else target
+            trades[row] = True
+
+            stop = calendar_rows[next_calendar[row]]
+            marked = mark(weights[row], returns[row + 1:stop + 1])
+            end = stop
+            if self.drift is not None or self.turnover is not None:
+                held = marked[:stop - row - 1]
+                hit = np.zeros(len(held), dtype=bool)
+                if self.drift is not None:
+                    hit |= np.abs(held - target).sum(axis=1) > self.drift
+                if self.turnover is not None:
+                    hit |= np.abs(held - daily[row + 1:stop]).sum(axis=1) > self.turnover
+                if hit.any():
+                    end = row + 1 + int(np.argmax(hit))
+            weights[row + 1:end] = marked[:end - row - 1]
+            if end < n:
+                current = marked[end - row - 1]
+            row = end
+        return weights, trades
+
+
+# This function returns the Schedule for a myStrategy rebalance setting: None (trade every date), a Schedule,
+# or a calendar setting of Schedule ('daily', 'weekly', 'month_end' or a number of days).
+def make_schedule(rebalance):
+    if rebalance is None or isinstance(rebalance, Schedule):
+        return rebalance
+    return Schedule(calendar=rebalance)
@@ -0,0 +1,97 @@
+import numpy as np
+
+##################################################################################
+# This module selects stocks cross-sectionally for all dates at once from a (dates x tickers) score matrix.
+# Selections are (dates x n) arrays of ticker column positions, best first, padded with -1 where fewer than n names qualify.
+# They convert to the {date: [tickers]} format myStrategy uses, or to a boolean (dates x tickers) selection matrix.
+##################################################################################
+
+
+# This function picks the n highest scores per date, ordered from highest, like Series.nlargest(n) on each date.
+# Names outside the mask are never picked. As with nlargest, names with a NaN score fill the remaining slots
+# after all valid scores, in column order; pass nan_last=False to leave those slots empty instead.
+def select_top(scores, n, mask=None, nan_last=True):
+    scores = np.asarray(scores, dtype=float)
+    eligible = np.ones(scores.shape, dtype=bool) if mask is None else np.asarray(mask, dtype=bool)
+    if not nan_last:
+        eligible = eligible & ~np.isnan(scores)
+    n = min(n, scores.shape[1])
+    if n == 0:
+        return np.empty((scores.shape[0], 0), dtype=np.intp)
+    key = np.where(np.isnan(scores), np.inf, -scores)
+    key = np.where(eligible, key, np.nan)  # NaN keys sort after everything, including the NaN scores at +inf
+
+    # A stable sort keeps the left-most column first among tied keys, as nlargest does; a partial partition would not
+    picks = np.argsort(key, axis=1, kind='stable')[:, :n]
+    return np.where(np.take_along_axis(eligible, picks, axis=1), picks, -1)
+
+
+# This function picks the n lowest scores per date, ordered from lowest, e.g. for the short leg.
+def select_bottom(scores, n, mask=None, nan_last=True):
+    return select_top(-np.asarray(scores, dtype=float), n, mask, nan_last)
+
+
+# This function assigns every valid name to one of q equally sized score buckets per date (0 = lowest scores), and -1 to invalid names.
+def quantile_buckets(scores, q, mask=None):
+    scores = np.asarray(scores, dtype=float)
+    valid = ~np.isnan(scores)
+    if mask is not None:
+        valid &= np.asarray(mask, dtype=bool)
+    key = np.where(valid, scores, np.inf)
+    ranks = np.argsort(np.argsort(key, axis=1, kind='stable'), axis=1, kind='stable')
+    count = valid.sum(axis=1, keepdims=True)
+    buckets = ranks * q // np.maximum(count, 1)
+    return np.where(valid, buckets, -1)
+
+
+# This function builds a mask of tradable names from a Universe panel: present and priced, optionally with minimum value volume and close price.
+def tradable_mask(panel, dates=None, tickers=None, min_valuevolume=None, min_close=None):
+    close = panel.matrix('close', dates, tickers)
+    mask = ~np.isnan(close)
+    if min_valuevolume is not None:
+        mask &= panel.matrix('valuevolume', dates, tickers) >= min_valuevolume
+    if min_close is not None:
+        mask &= close >= min_close
+    return mask
+
+
+# This function turns a selection into a boolean (dates x tickers) matrix.
+def to_matrix(picks, n_tickers):
+    matrix = np.zeros((picks.shape[0], n_tickers), dtype=bool)
+    rows, slots = np.nonzero(picks >= 0)
+    matrix[rows, picks[rows, slots]] = True
+    return matrix
+
+
+# This function turns a selection into the {date: [tickers]} format, keeping the best-first order.
+def to_dict(picks, dates, tickers):
+    tickers = np.asarray(tickers, dtype=object)
+    return {date: tickers[row[row >= 0]].tolist() for date, row in zip(dates, picks)}
+
+
+# This function turns a {date: [tickers]} selection back into selection positions, e.g. for a custom stock_select function.
+def from_dict(selection_dict, dates, tickers):
+    column = {ticker: j for j, ticker in enumerate(tickers)}
+    rows = [[column[ticker] for ticker in selection_dict.get(date, [])] for date in dates]
+    picks = np.full((len(dates), max(map(len, rows), default=0)), -1, dtype=np.intp)
+    for i, row in enumerate(rows):
+        picks[i, :len(row)] = row
+    return picks
+
+
+if __name__ == '__main__':
+    import pandas as pd
+    # Parity check against the per-date Series.nlargest of the original selection, on scores with many ties, NaNs and masked names
+    rng = np.random.default_rng(0)
+    mismatches = 0
+    for case in range(2000):
+        m, n = int(rng.integers(1, 40)), int(rng.integers(1, 15))
+        scores = rng.integers(0, 4, size=(5, m)).astype(float)
+        scores[rng.random((5, m)) < rng.random()] = np.nan
+        mask = rng.random((5, m)) > 0.2
+        picks = select_top(scores, n, mask)
+        for i in range(5):
+            columns = np.flatnonzero(mask[i])
+            expected = pd.Series(scores[i, columns], index=columns).nlargest(n).index.tolist()
+            mismatches += picks[i][picks[i] >= 0].tolist() != expected
+    print(f'{mismatches} dates differ from Series.nlargest')
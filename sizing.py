@@ -0,0 +1,122 @@
+from functools import lru_cache
+import numpy as np
+
+##################################################################################
+# This module turns a stock selection into position weights for all dates in one pass.
+# Selections are (dates x n) arrays of ticker column positions, best first and padded with -1 (see selection.py).
+# Weights are (dates x tickers) matrices; to_position_dict gives the {date: {ticker: weight}} view myStrategy returns.
+##################################################################################
+
+
+# This function returns the rank-normalized weights for k selected names, scaled to a gross exposure of 1.
+# It only depends on k, so it is computed once per k and reused for every date.
+@lru_cache(maxsize=None)
+def rank_template(k):
+    posi_ori = np.arange(k, 0, -1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        posi = (posi_ori - np.mean(posi_ori)) / np.std(posi_ori)
+    template = posi / np.sum(np.abs(posi))
+    template.setflags(write=False)
+    return template
+
+
+# This function fills each date with the template for its number of selected names.
+def template_weights(picks, n_tickers, template_func, leverage):
+    weights = np.zeros((picks.shape[0], n_tickers))
+    counts = (picks >= 0).sum(axis=1)
+    for k in np.unique(counts):
+        if k == 0:
+            continue
+        rows = np.flatnonzero(counts == k)
+        weights[rows[:, None], picks[rows, :k]] = template_func(k) * leverage
+    return weights
+
+
+# Default sizing: weights follow the normalized rank of each name in the selection, with gross exposure equal to leverage.
+def rank_weights(picks, n_tickers, leverage):
+    return template_weights(picks, n_tickers, rank_template, leverage)
+
+
+# Uniform sizing: leverage is split equally across the selected names.
+def uniform_weights(picks, n_tickers, leverage):
+    return template_weights(picks, n_tickers, lambda k: np.full(k, 1 / k), leverage)
+
+
+# Risk parity sizing: weights are proportional to the inverse volatility of the selected names, summing to leverage.
+# vol is a (dates x tickers) matrix; a NaN volatility makes that date's weights NaN, as in the per-date calculation.
+def inverse_vol_weights(picks, vol, leverage):
+    selected = picks >= 0
+    rows = np.arange(picks.shape[0])[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inverse = np.where(selected, 1 / vol[rows, np.maximum(picks, 0)], 0)
+        scaled = inverse / inverse.sum(axis=1, keepdims=True) * leverage
+    weights = np.zeros(vol.shape)
+    r, slot = np.nonzero(selected)
+    weights[r, picks[r, slot]] = scaled[r, slot]
+    return weights
+
+
+# This function solves for long-only weights (summing to 1) whose risk contributions w_i * (cov @ w)_i are proportional to budget,
+# by cyclical coordinate descent; with equal budgets these are the equal risk contribution (covariance risk parity) weights.
+def risk_budget(cov, budget=None, iterations=200, tol=1e-10):
+    k = len(cov)
+    budget = np.full(k, 1 / k) if budget is None else np.asarray(budget, dtype=float) / np.sum(budget)
+    var = np.diag(cov)
+    w = 1 / np.sqrt(var)
+    w /= w.sum()
+    for _ in range(iterations):
+        previous = w.copy()
+        for i in range(k):
+            c = cov[i] @ w - var[i] * w[i]  # Covariance of name i with the rest of the portfolio
+            w[i] = (-c + np.sqrt(c * c + 4 * var[i] * budget[i])) / (2 * var[i])
+        if np.max(np.abs(w / w.sum() - previous / previous.sum())) < tol:
+            break
+    return w / w.sum()
+
+
+# Covariance risk parity sizing: on each date the selected names get risk budget weights (see risk_budget) from covariance(i),
+# the (tickers x tickers) covariance of date row i, summing to leverage. budgets is a (tickers,) array of risk budgets, equal by default.
+# Selected names without a covariance (NaN variance, e.g. too little history) get a zero weight and the budget is shared by the others.
+def risk_budget_weights(picks, covariance, n_tickers, leverage, budgets=None):
+    weights = np.zeros((picks.shape[0], n_tickers))
+    for i in range(picks.shape[0]):
+        columns = picks[i][picks[i] >= 0]
+        if len(columns) == 0:
+            continue
+        cov = covariance(i)[np.ix_(columns, columns)]
+        known = ~np.isnan(np.diag(cov))
+        if not known.any():
+            continue
+        columns, cov = columns[known], cov[np.ix_(known, known)]
+        weights[i, columns] = risk_budget(cov, None if budgets is None else budgets[columns]) * leverage
+    return weights
+
+
+# This function turns a position dictionary like {'2019-01-01': {'AAPL': 0.3}} into a (dates x tickers) weight matrix.
+def weight_matrix(position_dict, dates, tickers):
+    column = {ticker: j for j, ticker in enumerate(tickers)}
+    weights = np.zeros((len(dates), len(tickers)))
+    for i, date in enumerate(dates):
+        for ticker, w in position_dict.get(date, {}).items():
+            weights[i, column[ticker]] = w
+    return weights
+
+
+# This function returns the {date: {ticker: weight}} view of a weight matrix, listing every name with a non-zero (or NaN) weight.
+def held_position_dict(weights, dates, tickers):
+    tickers = np.asarray(tickers, dtype=object)
+    position_dict = {}
+    for i, date in enumerate(dates):
+        columns = np.flatnonzero(weights[i] != 0)
+        position_dict[date] = dict(zip(tickers[columns].tolist(), weights[i, columns]))
+    return position_dict
+
+
+# This function returns the {date: {ticker: weight}} view of a weight matrix, listing the selected names in selection order.
+def to_position_dict(weights, picks, dates, tickers):
+    tickers = np.asarray(tickers, dtype=object)
+    position_dict = {}
+    for i, date in enumerate(dates):
+        columns = picks[i][picks[i] >= 0]
+        position_dict[date] = dict(zip(tickers[columns].tolist(), weights[i, columns]))
+    return position_dict
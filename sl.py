@@ -1,10 +1,19 @@
 import pandas as pd
 import csv
 import os 
-from sqlalchemy import create_engine, text, Table, MetaData
+from sqlalchemy import create_engine, event, text, Table, MetaData, Column, String, DateTime, Float, select, delete, and_, bindparam
+from sqlalchemy.dialects import sqlite, mysql
 import logging
 import yfinance as yf
 import concurrent.futures
+import threading
+import time
+import weakref
+import json
+import shutil
+import pyarrow as pa
+import pyarrow.dataset as ds
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
 
 MYSQL_HOST = os.getenv('MYSQL_HOST')
@@ -14,6 +23,12 @@ MYSQL_DB = os.getenv('MYSQL_DB')
 SYS_DB = os.getenv('SYS_DB')
 
 DATABASE_URL = f"mysql+mysqlconnector://{MYSQL_USER}:{MYSQL_PASSWORD}@{MYSQL_HOST}/{MYSQL_DB}"
+OHLC_DATABASE_URL = os.getenv('OHLC_DATABASE_URL', 'sqlite:///ohlc.db')  # Store of the consolidated OHLC table; a MySQL url works too
+
+POOL_SIZE = int(os.getenv('SL_POOL_SIZE', 8))  # Pooled connections kept open per engine and process
+MAX_OVERFLOW = int(os.getenv('SL_MAX_OVERFLOW', 16))  # Extra connections allowed under load, closed when returned
+POOL_RECYCLE = 3600
+POOL_TIMEOUT = 30
 
 logging.basicConfig(filename='username',
                     filemode='a',
@@ -53,18 +68,113 @@ def load_dict(file_path):
 
 
 #####################################################
-def get_engine(**kwargs):
-    engine = create_engine(DATABASE_URL, **kwargs)
+# Engine registry: every helper in this module shares one pooled engine per database url (and engine options) in each process.
+# Engines are never created per call. After a fork, e.g. in a multiprocessing worker, the inherited engines are dropped
+# without closing the parent's connections, and the child creates its own on first use.
+# Pool activity is counted for all engines; see pool_stats.
+#####################################################
+_engines = {}
+_engines_pid = os.getpid()
+_engines_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {'engines_created': 0, 'connections_opened': 0, 'checkouts': 0, 'queries': 0, 'query_time': 0.0}
+
+def _count(name, value=1):
+    with _stats_lock:
+        _stats[name] += value
+
+def _reset_after_fork():
+    global _engines_pid, _engines_lock, _stats_lock
+    for engine in _engines.values():
+        engine.dispose(close=False)  # The parent process still owns these connections
+    _engines.clear()
+    _engines_pid = os.getpid()
+    _engines_lock = threading.Lock()
+    _stats_lock = threading.Lock()
+    for name in _stats:
+        _stats[name] = type(_stats[name])()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _instrument(engine):
+    @event.listens_for(engine.pool, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        _count('connections_opened')
+
+    @event.listens_for(engine.pool, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        _count('checkouts')
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_execute(connection, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - connection.info['query_start'].pop()
+        with _stats_lock:
+            _stats['queries'] += 1
+            _stats['query_time'] += elapsed
+
+def _pool_options(url, kwargs):
+    url = make_url(url)
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        return kwargs  # In-memory SQLite uses a single connection per thread and takes no queue options
+    options = {'pool_size': POOL_SIZE, 'max_overflow': MAX_OVERFLOW, 'pool_recycle': POOL_RECYCLE, 'pool_timeout': POOL_TIMEOUT, 'pool_pre_ping': True}
+    options.update(kwargs)
+    return options
+
+# This function returns the shared engine of this process for a database url (DATABASE_URL by default), creating it on first use.
+# kwargs are create_engine options; by default the pool follows POOL_SIZE and MAX_OVERFLOW. Do not dispose the returned engine.
+def get_engine(url=None, **kwargs):
+    url = url or DATABASE_URL
+    if os.getpid() != _engines_pid:  # Forked without register_at_fork
+        _reset_after_fork()
+    key = (url, tuple(sorted(kwargs.items())))
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            engine = create_engine(url, **_pool_options(url, kwargs))
+            _instrument(engine)
+            _engines[key] = engine
+            _count('engines_created')
     return engine
 
+# This function changes the default pool size of engines created from now on, e.g. before starting a thread pool larger than the pool.
+def configure_pool(pool_size=None, max_overflow=None, pool_recycle=None, pool_timeout=None):
+    global POOL_SIZE, MAX_OVERFLOW, POOL_RECYCLE, POOL_TIMEOUT
+    POOL_SIZE = POOL_SIZE if pool_size is None else pool_size
+    MAX_OVERFLOW = MAX_OVERFLOW if max_overflow is None else max_overflow
+    POOL_RECYCLE = POOL_RECYCLE if pool_recycle is None else pool_recycle
+    POOL_TIMEOUT = POOL_TIMEOUT if pool_timeout is None else pool_timeout
+    return
+
+# This function closes all engines of this process, e.g. at shutdown or after changing the pool configuration.
+def dispose_engines():
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+    return
+
+# This function returns the pool counters of this process: connections opened, checkouts, the share of checkouts
+# served by an already open connection (reuse_rate), and the number and mean latency in seconds of queries.
+def pool_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['reuse_rate'] = 1 - stats['connections_opened'] / stats['checkouts'] if stats['checkouts'] else 0.0
+    stats['mean_query_latency'] = stats['query_time'] / stats['queries'] if stats['queries'] else 0.0
+    return stats
+
 def create_database(database_name):
-    engine = create_engine(f"mysql+mysqlconnector://{MYSQL_USER}:{MYSQL_PASSWORD}@{MYSQL_HOST}/{SYS_DB}")
+    engine = get_engine(f"mysql+mysqlconnector://{MYSQL_USER}:{MYSQL_PASSWORD}@{MYSQL_HOST}/{SYS_DB}")
     with engine.connect() as connection:
         connection.execute(text(f"CREATE DATABASE {database_name}"))
         logging.info(f"Database {database_name} created successfully")
 
 def ohlc_save_to_db(dataframe, code):
-    engine = create_engine(DATABASE_URL)
+    engine = get_engine()
     try:
         dataframe.to_sql(code.lower(), engine, if_exists='replace', index=True, index_label='Date')
         logging.info(f"Data saved to {code} table successfully.")
@@ -73,13 +183,12 @@ def ohlc_save_to_db(dataframe, code):
             dataframe.to_sql(code.lower(), engine, if_exists='replace', index = False)
         except Exception as e:
             logging.error(f"Error saving {code} to database: {str(e)}")
-    engine.dispose()
 
 
 
 ########################################
 def mpchunk_save(df, name, chunk_size = 1000):
-    engine = get_engine(pool_size=24, max_overflow=24, pool_recycle=3600, pool_timeout=30)
+    engine = get_engine()
     Session = sessionmaker(bind=engine)
     def upload_chunk(df_slice, table_name):
         session = Session()
@@ -96,7 +205,7 @@ def mpchunk_save(df, name, chunk_size = 1000):
     df_chunks = (df.iloc[i:i + chunk_size] for i in range(0, df.shape[0], chunk_size))
     print(df.shape[0])
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=20) as executor:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=POOL_SIZE + MAX_OVERFLOW) as executor:
         futures = [executor.submit(upload_chunk, chunk, name) for chunk in df_chunks]
         concurrent.futures.wait(futures)
     return
@@ -105,11 +214,8 @@ def mpchunk_save(df, name, chunk_size = 1000):
 
 ########################################
 def retrieve_data(query):
-    engine = create_engine(DATABASE_URL)
-    with engine.connect() as connection:
+    with get_engine().connect() as connection:
         result = pd.read_sql(query, connection)
-        connection.close()
-    engine.dispose()
     return result
 
 def retrieve(code):
@@ -121,15 +227,14 @@ def retrieve(code):
         return None
     return data
 
-def mpretrieve(code, engine):
+def mpretrieve(code, engine=None):
     query  = f'select * from `{str(code)}`'
-    with engine.connect() as connection:
+    with (engine or get_engine()).connect() as connection:
         try:
             data = pd.read_sql(query, connection)
         except Exception as e:
             logging.error(f"Error retrieving {code} from database: {str(e)}")
             return None
-        connection.close()
     return data
 
 def mpretrieve2(table_codes):
@@ -146,6 +251,222 @@ def mpretrieve2(table_codes):
     return results
 
 
+
+########################################
+# Consolidated OHLC store: one long table keyed by (Ticker, Date) instead of one table per ticker.
+# Rows are upserted in batches and read back for many tickers and a date range in a single query, optionally streamed in chunks.
+########################################
+OHLC_COLUMNS = ['Date', 'Open', 'High', 'Low', 'Close', 'Volume', 'Dividends', 'Stock Splits', 'Ticker']  # Layout of the per-ticker tables
+OHLC_VALUES = ['Open', 'High', 'Low', 'Close', 'Volume', 'Dividends', 'Stock Splits']
+
+ohlc_metadata = MetaData()
+ohlc_table = Table('ohlc', ohlc_metadata,
+                   Column('Ticker', String(32), primary_key=True),
+                   Column('Date', DateTime, primary_key=True),
+                   *[Column(name, Float) for name in OHLC_VALUES])
+
+
+_ohlc_ready = weakref.WeakSet()  # Engines on which the OHLC table is known to exist
+
+# This function returns the shared engine of the OHLC store (OHLC_DATABASE_URL by default) and creates the table on first use.
+def get_ohlc_engine(url=None, **kwargs):
+    engine = get_engine(url or OHLC_DATABASE_URL, **kwargs)
+    if engine not in _ohlc_ready:
+        ohlc_metadata.create_all(engine)  # No-op when the table exists
+        _ohlc_ready.add(engine)
+    return engine
+
+# This function brings a frame in the layout of download_ohlc (Date index or column, yfinance columns) to the rows of the OHLC table.
+# Dates are stored as naive exchange-local timestamps; missing value columns are stored as NULL.
+def ohlc_records(dataframe, code=None):
+    df = dataframe if 'Date' in dataframe.columns else dataframe.rename_axis('Date').reset_index()
+    dates = pd.to_datetime(df['Date'])
+    if dates.dt.tz is not None:
+        dates = dates.dt.tz_localize(None)
+    rows = pd.DataFrame({'Ticker': df['Ticker'] if 'Ticker' in df.columns else code, 'Date': dates})
+    for name in OHLC_VALUES:
+        rows[name] = df[name].astype(float) if name in df.columns else float('nan')
+    rows = rows.astype(object).where(rows.notna(), None)
+    return rows.to_dict('records')
+
+# This function returns an INSERT that overwrites existing (Ticker, Date) rows, for the dialects that support it, or None.
+def upsert_statement(engine):
+    if engine.dialect.name == 'sqlite':
+        stmt = sqlite.insert(ohlc_table)
+        return stmt.on_conflict_do_update(index_elements=['Ticker', 'Date'], set_={name: stmt.excluded[name] for name in OHLC_VALUES})
+    if engine.dialect.name in ('mysql', 'mariadb'):
+        stmt = mysql.insert(ohlc_table)
+        return stmt.on_duplicate_key_update({name: stmt.inserted[name] for name in OHLC_VALUES})
+    return None
+
+# This function writes OHLC rows of one or many tickers to the store, replacing rows with the same (Ticker, Date).
+# code is the ticker when the frame has no 'Ticker' column. Rows are sent in batches of chunk_size, all in one transaction.
+def ohlc_upsert(dataframe, code=None, engine=None, chunk_size=5000):
+    engine = engine or get_ohlc_engine()
+    records = ohlc_records(dataframe, code)
+    stmt = upsert_statement(engine)
+    with engine.begin() as connection:
+        for i in range(0, len(records), chunk_size):
+            batch = records[i:i + chunk_size]
+            if stmt is None:  # Generic fallback: delete the keys, then insert
+                keys = [{'key_ticker': row['Ticker'], 'key_date': row['Date']} for row in batch]
+                connection.execute(delete(ohlc_table).where(and_(ohlc_table.c.Ticker == bindparam('key_ticker'), ohlc_table.c.Date == bindparam('key_date'))), keys)
+                connection.execute(ohlc_table.insert(), batch)
+            else:
+                connection.execute(stmt, batch)
+    logging.info(f"{len(records)} OHLC rows saved to the store.")
+    return len(records)
+
+def ohlc_query(tickers=None, start=None, end=None, columns=None):
+    columns = columns or OHLC_COLUMNS
+    query = select(*[ohlc_table.c[name] for name in columns])
+    if tickers is not None:
+        query = query.where(ohlc_table.c.Ticker.in_(list(tickers)))
+    if start is not None:
+        query = query.where(ohlc_table.c.Date >= pd.Timestamp(start).to_pydatetime())
+    if end is not None:
+        query = query.where(ohlc_table.c.Date <= pd.Timestamp(end).to_pydatetime())
+    return query.order_by(ohlc_table.c.Ticker, ohlc_table.c.Date)
+
+# This function reads the rows of many tickers and a date range (inclusive, None means unbounded) with one query, ordered by ticker then date.
+# The result has the columns of the per-ticker tables (see OHLC_COLUMNS) unless columns is given.
+# With chunksize it returns an iterator of DataFrames of at most chunksize rows instead, so the whole result is never held in memory.
+def ohlc_read(tickers=None, start=None, end=None, columns=None, chunksize=None, engine=None):
+    query = ohlc_query(tickers, start, end, columns)
+    engine = engine or get_ohlc_engine()
+    if chunksize is not None:
+        return ohlc_stream(query, chunksize, engine)
+    with engine.connect() as connection:
+        return pd.read_sql(query, connection, parse_dates=['Date'] if 'Date' in query.selected_columns else None)
+
+def ohlc_stream(query, chunksize, engine):
+    with engine.connect().execution_options(stream_results=True) as connection:
+        parse_dates = ['Date'] if 'Date' in query.selected_columns else None
+        for chunk in pd.read_sql(query, connection, chunksize=chunksize, parse_dates=parse_dates):
+            yield chunk
+
+# This function lists the tickers in the store.
+def ohlc_tickers(engine=None):
+    with (engine or get_ohlc_engine()).connect() as connection:
+        return [row[0] for row in connection.execute(select(ohlc_table.c.Ticker).distinct().order_by(ohlc_table.c.Ticker))]
+
+# This function copies legacy per-ticker tables (as written by ohlc_save_to_db) into the OHLC store.
+def ohlc_import_tables(codes, source_engine=None, engine=None):
+    imported = []
+    for code in codes:
+        data = mpretrieve(code.lower(), source_engine)
+        if data is not None and len(data):
+            ohlc_upsert(data, code, engine)
+            imported.append(code)
+    return imported
+
+
+########################################
+# Columnar files: long frames with 'Date' and 'Ticker' columns or index levels (the cleaned data of load_data, Universe data) are
+# stored as a compressed Parquet dataset, a directory partitioned hive-style by the year of Date (year=2019/...), by Ticker, or not at all.
+# Writes stream: an iterable of frames is written frame by frame, so the whole data is never held in memory.
+# Reads select columns and push ticker and date filters down to the partitions and to the row group statistics, so only matching data is read.
+# Unlike CSV, column types (timestamps, floats) come back as written, and unlike pickle, the files are safe to share.
+########################################
+PARQUET_COMPRESSION = 'zstd'
+PARTITIONS = (None, 'year', 'Ticker')
+
+# This function returns the frame with 'Date' and 'Ticker' as columns.
+def long_frame(dataframe):
+    if 'Date' not in dataframe.columns or 'Ticker' not in dataframe.columns:
+        dataframe = dataframe.reset_index()
+    return dataframe
+
+# This function returns the Arrow table of one frame, with the year partition column added.
+def parquet_table(dataframe, partition, schema=None):
+    dataframe = long_frame(dataframe)
+    table = pa.Table.from_pandas(dataframe, preserve_index=False)
+    if partition == 'year':
+        dates = dataframe['Date']
+        years = dates.dt.year if pd.api.types.is_datetime64_any_dtype(dates) else dates.astype(str).str[:4].astype(int)
+        table = table.append_column('year', pa.array(years.to_numpy(), type=pa.int32()))
+    if schema is not None:
+        table = table.select(schema.names).cast(schema)
+    return table
+
+# This function writes a frame, or an iterable of frames with the same columns (e.g. one per ticker, as they are produced), to a Parquet
+# dataset directory, replacing whatever was there before. partition is one of PARTITIONS; metadata is an optional dictionary kept
+# in the files and returned by parquet_metadata.
+def save_parquet(data, path, partition='year', compression=PARQUET_COMPRESSION, metadata=None):
+    if partition not in PARTITIONS:
+        raise ValueError(f"Invalid partition. Must be one of {PARTITIONS}")
+    frames = iter([data] if isinstance(data, pd.DataFrame) else data)
+    first = next((frame for frame in frames if len(frame)), None)
+    if first is None:
+        raise ValueError("No rows to write")
+    table = parquet_table(first, partition)
+    schema = table.schema.with_metadata({**(table.schema.metadata or {}), b'sl': json.dumps(metadata or {}, default=str).encode()})
+    if os.path.isdir(path):
+        shutil.rmtree(path)  # Partitions the new data does not write to would otherwise keep stale rows
+    elif os.path.exists(path):
+        os.remove(path)
+
+    def batches():
+        yield from table.replace_schema_metadata(schema.metadata).to_batches()
+        for frame in frames:
+            if len(frame):
+                yield from parquet_table(frame, partition, schema).replace_schema_metadata(schema.metadata).to_batches()
+
+    ds.write_dataset(batches(), path, schema=schema, format='parquet',
+                     partitioning=[partition] if partition else None, partitioning_flavor='hive' if partition else None,
+                     file_options=ds.ParquetFileFormat().make_write_options(compression=compression),
+                     existing_data_behavior='overwrite_or_ignore')
+    return path
+
+# This function opens a Parquet dataset written by save_parquet (or any Parquet file or directory of files).
+def parquet_dataset(path):
+    return ds.dataset(path, format='parquet', partitioning='hive')
+
+# This function returns the filter expression for tickers and an inclusive date range (None means unbounded).
+# Date bounds are also applied to the year partitions, so whole years outside the range are skipped.
+def parquet_filter(dataset, tickers=None, start=None, end=None):
+    conditions = []
+    if tickers is not None:
+        conditions.append(ds.field('Ticker').isin(list(tickers)))
+    date_type = dataset.schema.field('Date').type
+    for bound, value in (('start', start), ('end', end)):
+        if value is None:
+            continue
+        timestamp = pd.Timestamp(value)
+        if pa.types.is_timestamp(date_type) or pa.types.is_date(date_type):
+            scalar = pa.scalar(timestamp.to_pydatetime(), type=pa.timestamp('us')).cast(date_type)
+        else:
+            scalar = timestamp.strftime('%Y-%m-%d')  # Dates stored as 'YYYY-MM-DD' strings compare in date order
+        conditions.append(ds.field('Date') >= scalar if bound == 'start' else ds.field('Date') <= scalar)
+        if 'year' in dataset.schema.names:
+            conditions.append(ds.field('year') >= timestamp.year if bound == 'start' else ds.field('year') <= timestamp.year)
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return expression
+
+# This function reads the rows of some tickers and a date range (inclusive, None means unbounded) from a Parquet dataset.
+# Only the given columns are read (all but the year partition column by default).
+# With chunksize it returns an iterator of DataFrames of at most chunksize rows instead, so the whole result is never held in memory.
+def read_parquet(path, columns=None, tickers=None, start=None, end=None, chunksize=None):
+    dataset = parquet_dataset(path)
+    columns = list(columns) if columns is not None else [name for name in dataset.schema.names if name != 'year']
+    expression = parquet_filter(dataset, tickers, start, end)
+    if chunksize is not None:
+        return parquet_stream(dataset, columns, expression, chunksize)
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+def parquet_stream(dataset, columns, expression, chunksize):
+    for batch in dataset.to_batches(columns=columns, filter=expression, batch_size=chunksize):
+        if batch.num_rows:
+            yield batch.to_pandas()
+
+# This function returns the metadata dictionary given to save_parquet.
+def parquet_metadata(path):
+    metadata = parquet_dataset(path).schema.metadata or {}
+    return json.loads(metadata[b'sl']) if b'sl' in metadata else {}
+
+
 if __name__ =='__main__':
     create_database('pjthai')
     # import load_data
@@ -2,14 +2,29 @@ import pandas as pd
 import sl
 import numpy as np
 from Universe import Universe
+import selection
+import sizing
+import features
+import riskmodel
+import schedule
+import resultcache
+from panel import Panel
 
 class myStrategy():
     # Constructor: Initializes the strategy with universe, stock selection method, position strategy, etc.
     # You can specify the stock selection function, position strategy, leverage limit, and date range.
-    def __init__(self, Universe, stock_select='default', n=10, position_strategy='default', leverage_limit=0.5, start='2018-12-28', end='2024-07-30'):
+    # score is the column the default selection ranks on: a universe field or a registered feature such as 'sharpe_ratio_180'.
+    # The 'erc' and 'risk_budget' position strategies size on the covariance of risk_model (by default the 180-day rolling covariance
+    # shared by all strategies on the universe, see riskmodel.py); risk_budget is a {ticker: budget} dictionary, 1 for names not listed.
+    # rebalance sets when the strategy trades: None trades every date, 'weekly', 'month_end' or a number of days trade on that calendar,
+    # and a schedule.Schedule adds drift/turnover triggers and a no-trade band. Selection and sizing then run only on trade dates,
+    # and position_dict holds the drifted weights in between.
+    # cache=True (or a directory or resultcache.ResultCache) makes calculate load the stored result when the universe and parameters are unchanged.
+    def __init__(self, Universe, stock_select='default', n=10, position_strategy='default', leverage_limit=0.5, start='2018-12-28', end='2024-07-30', score='sharpe_ratio', risk_model=None, risk_budget=None, rebalance=None, cache=None):
         self.UNI = Universe
         self.tick_posi = None
         self.stock_number = n  # Number of stocks to select
+        self.score = score  # Column used to rank stocks in the default selection
         self.dates = [date for date in Universe.dict_ticker[list(Universe.dict_ticker.keys())[0]].index.tolist() if date >= start and date <= end]
         self.leverage_limit = leverage_limit  # Maximum leverage allowed
 
@@ -30,65 +45,119 @@ class myStrategy():
             self.position_func = self.__uniform
         elif position_strategy == 'rp':
             self.position_func = self.__riskparity
+        elif position_strategy in ('erc', 'risk_budget'):
+            self.position_func = self.__riskbudget
         elif callable(position_strategy):
             self.position_func = position_strategy
         else:
             raise ValueError("Invalid position_strategy. Must be a callable function.")
 
         self.position_dict = {}  # Dictionary to store calculated positions
+        self.selection_matrix = None  # Boolean (dates x tickers) DataFrame of the selected stocks, set by the built-in position strategies
+        self.weights = None  # (dates x tickers) DataFrame of the positions, set by the built-in position strategies
+        self.rolling_std = None  # (panel dates x tickers) volatility used by the risk parity position strategy
+        self.risk_model = risk_model  # Covariance model used by the 'erc' and 'risk_budget' position strategies
+        self.risk_budget = risk_budget if position_strategy == 'risk_budget' else None
+        self.schedule = schedule.make_schedule(rebalance)
+        self.rebalance_dates = None  # Dates the strategy trades on, set by calculate when it has a rebalance schedule; None means every date
+        self.cache = resultcache.make_cache(cache)  # Result cache used by calculate, or None
+
+    # This method returns the (dates x tickers) matrix of the score column, computing it as a feature first if the universe does not have it yet.
+    def score_matrix(self):
+        if self.score not in self.UNI.panel.fields:
+            self.UNI.feature(self.score)
+        return self.UNI.panel.matrix(self.score, self.dates)
 
     # Default stock selection method: selects top N stocks by Sharpe ratio for each date.
+    # The top N of every date are picked in one batched operation over the score matrix instead of one sort per date.
     def __stock_select1(self):
-        short = {}
-        long = {}
-        total_selection = {}
-        for date in self.dates:
-            total_selection[date] = self.UNI.dict_date[date]['sharpe_ratio'].nlargest(self.stock_number).index.tolist()
-        return total_selection
+        picks = selection.select_top(self.score_matrix(), self.stock_number, mask=self.UNI.panel.presence(self.dates))
+        return selection.to_dict(picks, self.dates, self.UNI.panel.tickers)
+
+    # This method converts a {date: [tickers]} selection into selection positions and a boolean (dates x tickers) selection matrix.
+    def selection_arrays(self, stock_selection):
+        picks = selection.from_dict(stock_selection, self.dates, self.UNI.panel.tickers)
+        self.selection_matrix = pd.DataFrame(selection.to_matrix(picks, len(self.UNI.panel.tickers)), index=self.dates, columns=self.UNI.panel.tickers)
+        return picks
+
+    # This method stores the (dates x tickers) weight matrix and returns its {date: {ticker: weight}} view.
+    def positions_from_weights(self, weights, picks):
+        self.weights = pd.DataFrame(weights, index=self.dates, columns=self.UNI.panel.tickers)
+        return sizing.to_position_dict(weights, picks, self.dates, self.UNI.panel.tickers)
 
     # Default position strategy: assigns positions based on a normalized ranking of stocks.
     # Leverage is distributed proportionally across positions.
     def __default_daily_position(self, stock_selection, leverage):
-        position_dict = {}
-        for date in self.dates:
-            posi_ori = np.arange(len(stock_selection[date]), 0, -1)
-            posi = (posi_ori - np.mean(posi_ori)) / np.std(posi_ori)
-            k = leverage / sum([abs(p) for p in posi])
-            position_dict[date] = dict(zip(stock_selection[date], posi * k))
-        return position_dict
+        picks = self.selection_arrays(stock_selection)
+        return self.positions_from_weights(sizing.rank_weights(picks, len(self.UNI.panel.tickers), leverage), picks)
 
     # Uniform position strategy: equally allocates leverage across all selected stocks.
     def __uniform(self, stock_selection, leverage):
-        position_dict = {}
-        for date in self.dates:
-            posi = np.ones(len(stock_selection[date]))  
-            k = leverage / sum([abs(p) for p in posi])
-            position_dict[date] = dict(zip(stock_selection[date], posi * k))
-        return position_dict
-
-    # Risk parity position strategy: positions are sized inversely to the rolling volatility of the stocks.
+        picks = self.selection_arrays(stock_selection)
+        return self.positions_from_weights(sizing.uniform_weights(picks, len(self.UNI.panel.tickers), leverage), picks)
+
+    # Risk parity position strategy: positions are sized inversely to the 180-day rolling volatility of the stocks.
+    # The volatility is read from the universe if it already has the rolling_std_180 feature, and computed once otherwise; the universe is not modified.
     # THIS METHOD SHOULD BE REFINED.
     def __riskparity(self, stock_selection, leverage):
-        position_dict = {}
-
-        for ticker in self.UNI.symbol_list:
-            self.UNI.dict_ticker[ticker]['rolling_std'] = self.UNI.dict_ticker[ticker]['close'].rolling(window=180).std()
-
-        # Calculate position weights based on the inverse of the standard deviation
-        for current_date in self.dates:
-            std_devs = []
-            for ticker in stock_selection[current_date]:
-                std_dev = self.UNI.dict_ticker[ticker]['rolling_std'].loc[current_date]
-                std_devs.append(std_dev)
-            inverse_std_devs = 1 / np.array(std_devs)
-            normalized_weights = inverse_std_devs / inverse_std_devs.sum() * leverage
-            position_dict[current_date] = dict(zip(stock_selection[current_date], normalized_weights))
-        return position_dict
+        picks = self.selection_arrays(stock_selection)
+        if self.rolling_std is None:
+            panel = self.UNI.panel
+            rolling_std = panel.fields['rolling_std_180'] if 'rolling_std_180' in panel.fields else features.compute(panel, 'rolling_std_180')
+            self.rolling_std = np.asarray(rolling_std)
+        vol = self.rolling_std[Panel.positions(self.UNI.panel.date_index, self.dates)]
+        return self.positions_from_weights(sizing.inverse_vol_weights(picks, vol, leverage), picks)
+
+    # Covariance risk parity position strategy: the selected names get equal risk contributions ('erc'), or contributions
+    # proportional to risk_budget ('risk_budget'), under the covariance of the risk model as of each date.
+    def __riskbudget(self, stock_selection, leverage):
+        picks = self.selection_arrays(stock_selection)
+        panel = self.UNI.panel
+        if self.risk_model is None:
+            self.risk_model = riskmodel.shared(panel)
+        rows = Panel.positions(panel.date_index, self.dates)
+        budgets = None
+        if self.risk_budget is not None:
+            budgets = np.array([self.risk_budget.get(ticker, 1) for ticker in panel.tickers], dtype=float)
+        weights = sizing.risk_budget_weights(picks, lambda i: self.risk_model.covariance_at(rows[i]), len(panel.tickers), leverage, budgets)
+        sized = np.take_along_axis(weights, np.maximum(picks, 0), axis=1) != 0
+        return self.positions_from_weights(weights, np.where(sized, picks, -1))  # Names left out for lack of history are not held
+
+    # This method returns the (len(rows) x tickers) target weights of the given rows of self.dates, running the selection and position
+    # strategy on those dates only.
+    def target_weights(self, rows):
+        dates = self.dates
+        self.dates = [dates[i] for i in rows]
+        try:
+            position_dict = self.position_func(self.stock_select_func(), self.leverage_limit)
+            return sizing.weight_matrix(position_dict, self.dates, self.UNI.panel.tickers)
+        finally:
+            self.dates = dates
 
     # Method to calculate stock selection and positions based on the selected strategy.
     def calculate(self):
-        total_selection = self.stock_select_func()  # Get selected stocks
-        self.position_dict = self.position_func(total_selection, self.leverage_limit)  # Calculate positions
+        if self.cache is not None:
+            key = resultcache.strategy_key(self)
+            if self.cache.restore(key, self):
+                return
+        if self.schedule is not None:
+            self.calculate_scheduled()
+        else:
+            total_selection = self.stock_select_func()  # Get selected stocks
+            self.position_dict = self.position_func(total_selection, self.leverage_limit)  # Calculate positions
+        if self.cache is not None:
+            self.cache.store(key, self, resultcache.STRATEGY_RESULTS)
+        return
+
+    # This method calculates the positions under the rebalance schedule: target weights on trade dates, marked to the daily returns in between.
+    def calculate_scheduled(self):
+        tickers = self.UNI.panel.tickers
+        returns = np.asarray(self.UNI.panel.matrix('pctChg', self.dates), dtype=float)
+        weights, trades = self.schedule.apply(self.dates, returns, self.target_weights)
+        self.rebalance_dates = [date for date, trade in zip(self.dates, trades) if trade]
+        self.weights = pd.DataFrame(weights, index=self.dates, columns=tickers)
+        self.selection_matrix = self.weights != 0
+        self.position_dict = sizing.held_position_dict(weights, self.dates, tickers)
         return
 
 
@@ -0,0 +1,133 @@
+import concurrent.futures
+import copy
+import itertools
+import pickle
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import pandas as pd
+import resultcache
+import features
+from Universe import Universe
+from panel import Panel
+from strategy import myStrategy
+from BT import BacktestModule
+
+##################################################################################
+# This module runs parameter sweeps of myStrategy + BacktestModule across a process pool.
+# The Universe is saved once in the memory-mapped directory format and every worker opens it read-only, so it is never pickled per run.
+# Features the runs need are attached before saving (see with_features), so they are computed once rather than in every run.
+##################################################################################
+
+STRATEGY_PARAMS = ('stock_select', 'n', 'position_strategy', 'leverage_limit', 'score', 'rebalance')  # Passed to myStrategy
+BACKTEST_PARAMS = ('t_cost', 'holding_feerate', 'initial_cash', 'engine')  # Passed to BacktestModule
+BACKTEST_DEFAULTS = {'engine': 'vectorized'}
+
+_universe = None  # The universe opened by each worker process
+
+
+def _open_universe(path):
+    global _universe
+    _universe = Universe.open(path)
+
+
+# This function expands a grid like {'n': [5, 10], 'position_strategy': ['uniform', 'rp']} into a list of parameter dictionaries.
+def parameter_grid(grid):
+    keys = list(grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+
+# This function attaches to the universe the features the grid needs and it does not have yet: registered features used as score,
+# and rolling_std_180 for risk parity sizing and the default cost model. It returns the names that were added.
+def prepare_features(universe, combinations):
+    needed = {params['score'] for params in combinations if 'score' in params}
+    if 'rolling_std' not in universe.panel.fields or any(params.get('position_strategy') == 'rp' for params in combinations):
+        needed.add('rolling_std_180')
+    added = []
+    for name in sorted(needed):
+        if name in universe.panel.fields:
+            continue
+        try:
+            features.parse(name)
+        except KeyError:
+            continue  # A plain field name; myStrategy reports it if it is missing
+        universe.feature(name)
+        added.append(name)
+    return added
+
+
+# This function returns (universe, added): a shallow copy of the universe that shares its field arrays, with the features of
+# prepare_features attached, and their names. The universe itself is left untouched.
+def with_features(universe, combinations):
+    shared = copy.copy(universe)
+    shared.panel = Panel(universe.panel.dates, universe.panel.tickers, universe.panel.fields, universe.panel.present)
+    shared.features = dict(universe.features)
+    return shared, prepare_features(shared, combinations)
+
+
+# This function runs one combination on the worker's universe and returns its parameters, statistics and equity curve.
+def run_one(params, start, end, backtest_start, backtest_end):
+    unknown = set(params) - set(STRATEGY_PARAMS) - set(BACKTEST_PARAMS)
+    if unknown:
+        raise ValueError(f"Unknown sweep parameters: {sorted(unknown)}")
+    strategy_kwargs = {key: value for key, value in params.items() if key in STRATEGY_PARAMS}
+    backtest_kwargs = dict(BACKTEST_DEFAULTS)
+    backtest_kwargs.update({key: value for key, value in params.items() if key in BACKTEST_PARAMS})
+
+    S = myStrategy(Universe=_universe, start=start, end=end, **strategy_kwargs)
+    S.calculate()
+    backtest = BacktestModule(S, start=backtest_start, end=backtest_end, **backtest_kwargs)
+    backtest.run_backtest()
+    return {'params': params, 'stats': backtest.summary(), 'equity': pd.Series(backtest.portfolio_value, dtype=float)}
+
+
+# This function returns the cache key of one run: a hash of its parameters, date range, the fingerprint of the universe it ran on
+# (see resultcache.universe_fingerprint) and the version of the strategy and backtest code.
+def run_key(params, start, end, backtest_start, backtest_end, universe_id):
+    return resultcache.digest('sweep', resultcache.code_version(), universe_id, params, start, end, backtest_start, backtest_end)
+
+
+# This function runs every combination of the grid and returns (results, curves):
+# results is a tidy DataFrame with one row per run (parameters plus the statistics of BacktestModule.summary),
+# curves is a DataFrame of equity curves with one column per run, in the same order as the rows of results.
+# universe is a Universe or the directory of one saved with Universe.save. With cache_dir, finished runs are stored there
+# and skipped when the sweep is run again, so an interrupted sweep resumes where it stopped.
+def sweep(universe, grid, start, end, backtest_start=None, backtest_end=None, max_workers=None, cache_dir=None):
+    backtest_start = backtest_start or start
+    backtest_end = backtest_end or end
+    combinations = parameter_grid(grid) if isinstance(grid, dict) else list(grid)
+
+    with TemporaryDirectory() as tmp:
+        path = None if isinstance(universe, Universe) else Path(universe)
+        if path is not None:
+            universe = Universe.open(path)
+        universe_id = resultcache.universe_fingerprint(universe)
+        # Features every run needs (rolling_std_180 for the default cost model, scores) are computed once here, not in each BacktestModule
+        shared, added = with_features(universe, combinations)
+        if path is None or added:
+            path = Path(tmp) / 'universe'
+            shared.save(path)
+
+        keys = [run_key(params, start, end, backtest_start, backtest_end, universe_id) for params in combinations]
+        results = {}
+        if cache_dir is not None:
+            cache_dir = Path(cache_dir)
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            for key in keys:
+                if (cache_dir / f'{key}.pkl').exists():
+                    with open(cache_dir / f'{key}.pkl', 'rb') as file:
+                        results[key] = pickle.load(file)
+
+        pending = [(key, params) for key, params in zip(keys, combinations) if key not in results]
+        if pending:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=_open_universe, initargs=(str(path),)) as executor:
+                futures = {executor.submit(run_one, params, start, end, backtest_start, backtest_end): key for key, params in pending}
+                for future in concurrent.futures.as_completed(futures):
+                    key = futures[future]
+                    results[key] = future.result()
+                    if cache_dir is not None:
+                        with open(cache_dir / f'{key}.pkl', 'wb') as file:
+                            pickle.dump(results[key], file)
+
+    rows = [dict(results[key]['params'], **results[key]['stats']) for key in keys]
+    curves = pd.concat([results[key]['equity'] for key in keys], axis=1, keys=range(len(keys)))
+    return pd.DataFrame(rows), curves
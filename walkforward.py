@@ -0,0 +1,85 @@
+import concurrent.futures
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import numpy as np
+import pandas as pd
+from Universe import Universe
+import analytics
+import sweep
+
+##################################################################################
+# This module evaluates myStrategy out of sample with walk-forward folds. The universe dates are split into train/test folds, the
+# parameter grid is searched on each train window, the best parameters are run on the following test window, and the test
+# curves are chained into one out-of-sample equity curve.
+# Rolling features are causal (the value on a date only uses earlier rows), so the ones the grid needs are computed once over
+# the whole panel and shared by every fold; folds run in parallel in a process pool, as in sweep.py.
+##################################################################################
+
+
+# This function splits dates into walk-forward folds of `train` then `test` trading days, moving forward by `step` days (default: test).
+# With expanding=True every train window starts at the first date instead of rolling forward. A last test window shorter than `test` is kept.
+def make_folds(dates, train, test, step=None, expanding=False):
+    step = step or test
+    if step < test:
+        raise ValueError("step must be at least test, so test windows do not overlap")
+    dates = list(dates)
+    folds = []
+    for first in range(0, len(dates) - train, step):
+        test_end = min(first + train + test, len(dates))
+        folds.append({'fold': len(folds),
+                      'train_start': dates[0 if expanding else first],
+                      'train_end': dates[first + train - 1],
+                      'test_start': dates[first + train],
+                      'test_end': dates[test_end - 1]})
+    return folds
+
+
+# This function searches the grid on the train window of one fold and runs the best parameters on its test window.
+# It runs in a worker whose universe was opened by sweep._open_universe.
+def run_fold(fold, combinations, metric, maximize):
+    train = []
+    for params in combinations:
+        result = sweep.run_one(params, fold['train_start'], fold['train_end'], fold['train_start'], fold['train_end'])
+        train.append((result['stats'][metric], params))
+    scores = np.array([score for score, _ in train], dtype=float)
+    scores = np.where(np.isnan(scores), -np.inf, scores if maximize else -scores)
+    best_score, best = train[int(np.argmax(scores))]
+    test = sweep.run_one(best, fold['test_start'], fold['test_end'], fold['test_start'], fold['test_end'])
+    growth = test['equity'] / best.get('initial_cash', 100_0000)
+    return {'fold': fold, 'params': best, 'train_score': best_score, 'stats': test['stats'], 'growth': growth}
+
+
+# This function chains the growth curves (equity / initial cash) of consecutive folds into one equity curve:
+# each fold starts where the previous one ended.
+def stitch(growths, initial_cash=100_0000):
+    pieces = []
+    level = 1.0
+    for growth in growths:
+        pieces.append(growth * level)
+        level = pieces[-1].iloc[-1]
+    return pd.concat(pieces) * initial_cash
+
+
+# This function runs a walk-forward evaluation and returns (folds, curve, summary):
+# folds is a DataFrame with one row per fold (dates, chosen parameters, train score and test statistics),
+# curve is the stitched out-of-sample equity curve, and summary its statistics from analytics.summary.
+# grid is searched on every train window and the parameters with the best `metric` (a key of BacktestModule.summary) are tested.
+# universe is a Universe or the directory of one saved with Universe.save.
+def walk_forward(universe, grid, train, test, step=None, expanding=False, metric='sharpe', maximize=True, max_workers=None):
+    combinations = sweep.parameter_grid(grid) if isinstance(grid, dict) else list(grid)
+    if not isinstance(universe, Universe):
+        universe = Universe.open(universe)
+    folds = make_folds(universe.panel.dates, train, test, step, expanding)
+    if not folds:
+        raise ValueError(f"{len(universe.panel.dates)} dates are not enough for a {train}-day train window")
+    shared, _ = sweep.with_features(universe, combinations)
+
+    with TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'universe'
+        shared.save(path)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=sweep._open_universe, initargs=(str(path),)) as executor:
+            results = list(executor.map(run_fold, folds, [combinations] * len(folds), [metric] * len(folds), [maximize] * len(folds)))
+
+    rows = [dict(result['fold'], **result['params'], train_score=result['train_score'], **result['stats']) for result in results]
+    curve = stitch([result['growth'] for result in results], results[0]['params'].get('initial_cash', 100_0000))
+    return pd.DataFrame(rows), curve, analytics.summary(curve).iloc[0].to_dict()